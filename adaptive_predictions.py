@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from cache import DiskCache
+from dedup import count_unique, find_duplicate_groups
+from instrumentation import REPORT_INTERVAL, MetricsReporter
+from journal import load_journal
+from make_predictions_and_visualize import CACHE_FILE, get_output_paths, plot_on_map, run_task_for_data
+from map_rendering import RENDERERS
+from select_visualization_prompts import embed_points, select_spread_out_points_with_importance_sampling
+from utils import extract_data_batch, load_prompt_table
+
+POPULATION_FILE = "data/ppp_2020_1km_Aggregated.tif"
+EARTH_RADIUS_IN_KM = 6371.0088
+NEIGHBORS = 8
+POWER = 2
+CANDIDATES_PER_CALL = 3
+
+class NeighborInterpolator:
+    """Inverse-distance weighted k-nearest-neighbor interpolation on the sphere, using a KD-tree over unit vectors.
+
+    The uncertainty of an estimate is the weighted spread of its neighbors (local disagreement) plus a term that grows
+    with the distance to the nearest known point, up to the overall spread of the known values.
+    """
+
+    def __init__(self, points, values, neighbors=NEIGHBORS, power=POWER):
+        self.vectors = embed_points(points, "haversine")
+        self.values = np.asarray(values, dtype=np.float64)
+        self.tree = cKDTree(self.vectors)
+        self.neighbors = min(neighbors, len(self.values))
+        self.power = power
+
+        distances, _ = self.query(self.vectors, 2)
+        self.length_scale = max(float(np.median(distances[:, 1])) if len(self.values) > 1 else 1.0, 1e-3)
+        self.spread = float(np.std(self.values))
+
+    def query(self, vectors, neighbors):
+        chords, indices = self.tree.query(vectors, k=neighbors)
+        chords, indices = chords.reshape(len(vectors), -1), indices.reshape(len(vectors), -1)
+        return 2 * EARTH_RADIUS_IN_KM * np.arcsin(np.clip(chords / 2, 0, 1)), indices
+
+    def estimate(self, distances, indices):
+        weights = 1 / np.maximum(distances, 1e-3) ** self.power
+        weights /= weights.sum(axis=1, keepdims=True)
+        values = self.values[indices]
+        means = (weights * values).sum(axis=1)
+        disagreement = np.sqrt((weights * (values - means[:, None]) ** 2).sum(axis=1))
+        nearest = distances[:, 0]
+        return means, disagreement + self.spread * nearest / (nearest + self.length_scale)
+
+    def predict(self, points):
+        return self.estimate(*self.query(embed_points(points, "haversine"), self.neighbors))
+
+    def leave_one_out_error(self):
+        """Mean absolute error of predicting every known point from the others."""
+        if len(self.values) <= self.neighbors:
+            return None
+        distances, indices = self.query(self.vectors, self.neighbors + 1)
+        means, _ = self.estimate(distances[:, 1:], indices[:, 1:])
+        return float(np.mean(np.abs(means - self.values)))
+
+def load_values(journal_file, value="expected_value"):
+    """Predictions by prompt index from a journal, preferring `value` and falling back to the most probable rating."""
+    values = {}
+    for index, record in load_journal(journal_file).items():
+        prediction = record.get(value)
+        if prediction is None:
+            prediction = record.get("most_probable")
+        if prediction is not None:
+            values[index] = prediction
+    return values
+
+def select_uncertain(points, candidates, uncertainty, count, seed=None):
+    """The `count` most uncertain candidates, spread out so one round does not spend its calls on a single region."""
+    order = np.argsort(-uncertainty, kind="stable")[:CANDIDATES_PER_CALL * count]
+    top = candidates[order]
+    selected = select_spread_out_points_with_importance_sampling(points[top], uncertainty[order], count, metric="haversine", seed=seed)
+    return top[list(selected)]
+
+def run_adaptive_predictions(model_api, model, task, prompt_file_path, api_key, budget, seed_size=None, round_size=None,
+                             population_file=POPULATION_FILE, value="expected_value", neighbors=NEIGHBORS, seed=None,
+                             map_renderer="canvas", **kwargs):
+    """Predicts a spread-out seed set, then spends the rest of the `budget` (in prompts) round by round on the prompts
+    whose interpolated prediction is the most uncertain. Writes a dense surface for every prompt and a report.
+
+    Prompts already in the task's journal count as queried, so an interrupted run resumes where it stopped. Identical
+    prompts are predicted once, so they only use the budget once.
+    """
+    table = load_prompt_table(prompt_file_path)
+    points = np.column_stack([table["latitudes"], table["longitudes"]])
+    num_prompts = len(points)
+    duplicates = find_duplicate_groups(table["latitudes"], table["longitudes"], table["texts"])
+    num_unique = count_unique(num_prompts, duplicates)
+    budget = min(budget, num_unique)
+    seed_size = min(seed_size or budget // 2, budget)
+    round_size = round_size or max((budget - seed_size) // 5, 1)
+
+    run_file_path, base_file_paths = get_output_paths(model, [task], prompt_file_path)
+    journal_file = f"{base_file_paths[task]}.journal.jsonl"
+
+    if population_file and os.path.exists(population_file):
+        populations = np.nan_to_num(extract_data_batch(points, population_file))
+    else:
+        populations = np.ones(num_prompts)
+
+    def count_calls(queried):
+        return len({duplicates.get(index, (index,))[0] for index in np.nonzero(queried)[0].tolist()})
+
+    queried = np.zeros(num_prompts, dtype=bool)
+    queried[list(load_journal(journal_file))] = True
+    seed_size = max(seed_size - count_calls(queried), 0)
+    candidates = np.nonzero(~queried)[0]
+    batch = np.zeros(0, dtype=np.int64)
+    if seed_size:
+        batch = candidates[list(select_spread_out_points_with_importance_sampling(points[candidates], populations[candidates], seed_size, metric="haversine", seed=seed))]
+    rounds = []
+
+    while True:
+        run_task_for_data(model_api, model, task, prompt_file_path, api_key, indices=batch, table=table, map_renderer=map_renderer, **kwargs)
+        # Identical prompts are sent once and their prediction is journaled for all of them.
+        queried[[member for index in batch.tolist() for member in duplicates.get(index, (index,))]] = True
+        calls = count_calls(queried)
+
+        values = load_values(journal_file, value)
+        known = np.array(sorted(index for index in values if queried[index]), dtype=np.int64)
+        if not len(known):
+            raise ValueError(f"No predictions could be parsed for {task}; nothing to interpolate from.")
+        interpolator = NeighborInterpolator(points[known], [values[index] for index in known], neighbors)
+        candidates = np.nonzero(~queried)[0]
+        estimates, uncertainty = interpolator.predict(points[candidates]) if len(candidates) else (np.zeros(0), np.zeros(0))
+
+        rounds.append({
+            "round": len(rounds),
+            "queried": int(len(batch)),
+            "total_queried": calls,
+            "total_known": int(queried.sum()),
+            "answered": int(len(known)),
+            "leave_one_out_mae": interpolator.leave_one_out_error(),
+            "mean_uncertainty": float(uncertainty.mean()) if len(uncertainty) else 0.0,
+            "max_uncertainty": float(uncertainty.max()) if len(uncertainty) else 0.0
+        })
+        print(f"Round {len(rounds) - 1}: {rounds[-1]['total_queried']} of {num_unique} unique prompts queried, "
+              f"mean uncertainty {rounds[-1]['mean_uncertainty']:.3f}, leave-one-out MAE {rounds[-1]['leave_one_out_mae']}")
+
+        remaining = budget - calls
+        if remaining <= 0 or not len(candidates):
+            break
+        batch = select_uncertain(points, candidates, uncertainty, min(round_size, remaining, len(candidates)), seed)
+
+    surface = np.full(num_prompts, np.nan)
+    surface_uncertainty = np.zeros(num_prompts)
+    surface[candidates] = estimates
+    surface_uncertainty[candidates] = uncertainty
+    surface[known] = interpolator.values
+    missing = np.nonzero(np.isnan(surface))[0]
+    if len(missing):
+        surface[missing], surface_uncertainty[missing] = interpolator.predict(points[missing])
+
+    surface_file = f"{base_file_paths[task]}_adaptive.csv"
+    pd.DataFrame({
+        "Latitude": points[:, 0],
+        "Longitude": points[:, 1],
+        "Predictions": surface,
+        "Uncertainty": surface_uncertainty,
+        "Queried": queried
+    }).to_csv(surface_file, index=False)
+    plot_on_map(points[:, 0], points[:, 1], surface, f"{base_file_paths[task]}_adaptive.html", map_renderer)
+
+    report = {
+        "task": task,
+        "prompts": num_prompts,
+        "budget": budget,
+        "unique_prompts": num_unique,
+        "queried": calls,
+        "calls_saved": num_unique - calls,
+        "fraction_saved": float(1 - calls / num_unique) if num_unique else 0.0,
+        "surface_file": surface_file,
+        "rounds": rounds
+    }
+    with open(f"{base_file_paths[task]}_adaptive_report.json", "w") as file:
+        json.dump(report, file, indent=4)
+
+    print(f"Queried {report['queried']} of {num_unique} unique prompts ({report['calls_saved']} calls saved, {report['fraction_saved']:.1%}). Surface written to {surface_file}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict a dense surface from a fraction of the prompts, spending calls where the interpolated predictions are the most uncertain.")
+    parser.add_argument("model_api", type=str, help="The API to use for predictions (openai, google, together, local)")
+    parser.add_argument("api_key", type=str, help="The API key (ignored for local)")
+    parser.add_argument("model", type=str, help="The model to use for predictions")
+    parser.add_argument("prompts_file", type=str, help="The file containing prompts")
+    parser.add_argument("task", type=str, help="The task to make predictions for")
+    parser.add_argument("--budget", type=int, help="Maximum number of prompts to send to the model.")
+    parser.add_argument("--budget_fraction", type=float, default=0.2, help="Budget as a fraction of the unique prompts, if --budget is not given.")
+    parser.add_argument("--seed_size", type=int, help="Number of spread-out prompts predicted in the first round. Defaults to half the budget.")
+    parser.add_argument("--round_size", type=int, help="Number of prompts predicted in each later round. Defaults to a fifth of the rest of the budget.")
+    parser.add_argument("--neighbors", type=int, default=NEIGHBORS, help="Number of nearest predictions used to interpolate each point.")
+    parser.add_argument("--value", type=str, default="expected_value", choices=["expected_value", "most_probable"], help="Which prediction to interpolate.")
+    parser.add_argument("--population_file", type=str, default=POPULATION_FILE, help="Population raster used to weight the seed set. Uniform weights are used if it does not exist.")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible selections.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of in-flight requests. Values above 1 enable the asynchronous engine.")
+    parser.add_argument("--api_base", type=str, help="Override the provider base URL (e.g. a local OpenAI-compatible server).")
+    parser.add_argument("--cache", type=str, default=CACHE_FILE, help="Path to the on-disk response cache.")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read from or write to the response cache.")
+    parser.add_argument("--metrics_interval", type=float, default=REPORT_INTERVAL, help="Seconds between progress lines (0 to disable).")
+    parser.add_argument("--map_renderer", type=str, default="canvas", choices=sorted(RENDERERS), help="How to draw the prediction maps.")
+
+    args = parser.parse_args()
+
+    table = load_prompt_table(args.prompts_file)
+    num_unique = count_unique(len(table["texts"]), find_duplicate_groups(table["latitudes"], table["longitudes"], table["texts"]))
+    budget = args.budget or max(int(args.budget_fraction * num_unique), 1)
+    cache = None if args.no_cache else DiskCache(args.cache)
+
+    try:
+        with MetricsReporter(args.metrics_interval):
+            run_adaptive_predictions(
+                args.model_api, args.model, args.task, args.prompts_file, args.api_key, budget,
+                seed_size=args.seed_size,
+                round_size=args.round_size,
+                population_file=args.population_file,
+                value=args.value,
+                neighbors=args.neighbors,
+                seed=args.seed,
+                map_renderer=args.map_renderer,
+                concurrency=args.concurrency,
+                api_base=args.api_base,
+                cache=cache
+            )
+    finally:
+        if cache:
+            cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import random
+import aiohttp
+from instrumentation import RETRIES, Timer
+from rate_limiting import RateLimiter
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+class ProviderError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+def is_retryable(error):
+    if isinstance(error, ProviderError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError, aiohttp.ClientError))
+
+def backoff_delay(attempt, error=None):
+    if isinstance(error, ProviderError) and error.retry_after is not None:
+        try:
+            return float(error.retry_after)
+        except ValueError:
+            pass
+    delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+    return delay + random.uniform(0, delay / 2)
+
+async def post_json(session, url, payload, api_key):
+    headers = {
+        "accept": "application/json",
+        "content-type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    async with session.post(url, json=payload, headers=headers) as response:
+        if response.status != 200:
+            raise ProviderError(response.status, await response.text(), response.headers.get("Retry-After"))
+        return await response.json(content_type=None)
+
+async def predict_with_retries(predict, prompt, limiter, tokens, timeout, max_retries, endpoint="llm", hedger=None):
+    async def request():
+        with Timer(endpoint, (asyncio.TimeoutError, aiohttp.ServerTimeoutError)):
+            return await predict(prompt)
+
+    async def acquire():
+        await limiter.acquire_async(tokens)
+
+    attempt = 0
+    while True:
+        try:
+            if hedger is None:
+                await acquire()
+                return await asyncio.wait_for(request(), timeout)
+            return await hedger.call_async(request, timeout, acquire)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            RETRIES.inc(endpoint=endpoint)
+            await asyncio.sleep(backoff_delay(attempt, e))
+            attempt += 1
+
+async def run_prompts_async(predict, prompts, concurrency=16, requests_per_minute=None, tokens_per_minute=None,
+                            timeout=20, max_retries=5, estimate_tokens=None, on_result=None, endpoint="llm", hedger=None):
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    results = [None] * len(prompts)
+    queue = asyncio.Queue()
+    for index, prompt in enumerate(prompts):
+        queue.put_nowait((index, prompt))
+
+    async def worker():
+        while True:
+            try:
+                index, prompt = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            tokens = estimate_tokens(prompt) if estimate_tokens else 0
+            try:
+                results[index] = await predict_with_retries(predict, prompt, limiter, tokens, timeout, max_retries, endpoint, hedger)
+            except Exception as e:
+                print(f"Error encountered on prompt {index + 1}: {e!r}. Skipping this prompt.")
+            if on_result:
+                on_result(index, prompt, results[index])
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(prompts))))))
+    return results
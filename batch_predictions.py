@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import time
+import requests
+from cache import DiskCache
+from dedup import count_unique, describe_duplicates, find_duplicate_groups
+from instrumentation import REPORT_INTERVAL, MetricsReporter, Timer
+from journal import Journal
+from make_predictions_and_visualize import (API_BASES, CACHE_FILE, add_usage, get_cache_key,
+                                            get_chat_request, get_output_paths, parse_chat_response, record_prediction,
+                                            write_summary, write_usage)
+from map_rendering import RENDERERS
+from prompt_shards import read_json, write_json
+from utils import load_prompt_table, render_prompts
+
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 200 * 1024 ** 2
+COMPLETION_WINDOW = "24h"
+POLL_INTERVAL = 60
+MAX_ATTEMPTS = 5
+MAX_RESUBMITS = 3
+TIMEOUT = 300
+
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+def get_custom_id(task_position, index):
+    return f"{task_position}-{index}"
+
+def parse_custom_id(custom_id):
+    task_position, index = custom_id.split("-")
+    return int(task_position), int(index)
+
+def get_batch_request(model_api, model, prompt, custom_id, prefix_caching=False):
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": get_chat_request(model_api, model, prompt, prefix_caching)}
+
+def split_batches(lines, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    """Groups encoded request lines into batches below both provider limits."""
+    batches, batch, size = [], [], 0
+    for line in lines:
+        if batch and (len(batch) >= max_requests or size + len(line) > max_bytes):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(line)
+        size += len(line)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def write_batch_files(lines, batches_dir, first_batch, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    if not os.path.exists(batches_dir):
+        os.makedirs(batches_dir, exist_ok=True)
+
+    entries = []
+    for offset, batch in enumerate(split_batches(lines, max_requests, max_bytes)):
+        file_path = os.path.join(batches_dir, f"batch-{first_batch + offset:05d}.jsonl")
+        temporary_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.writelines(batch)
+        os.replace(temporary_path, file_path)
+        entries.append({"file": file_path, "requests": len(batch), "input_file_id": None, "batch_id": None, "status": None,
+                        "output_file_id": None, "error_file_id": None, "collected": False})
+    return entries
+
+def call_api(method, url, api_key, **kwargs):
+    """One batch API call, retried with exponential backoff on connection errors, 429 and 5xx responses."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            with Timer("batch", requests.exceptions.Timeout):
+                response = requests.request(method, url, headers={"Authorization": f"Bearer {api_key}"}, timeout=TIMEOUT, **kwargs)
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise requests.exceptions.HTTPError(f"HTTP {response.status_code}: {response.text}", response=response)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            print(f"Batch API error: {e}, retrying...")
+            time.sleep(2 ** attempt)
+            continue
+
+        response.raise_for_status()
+        return response
+
+def upload_file(api_base, api_key, file_path):
+    # Read the file once, so a retried upload sends the whole file again.
+    with open(file_path, "rb") as file:
+        data = file.read()
+    response = call_api("POST", f"{api_base}/files", api_key, data={"purpose": "batch"}, files={"file": (os.path.basename(file_path), data)})
+    return response.json()["id"]
+
+def create_batch(api_base, api_key, input_file_id):
+    payload = {"input_file_id": input_file_id, "endpoint": "/v1/chat/completions", "completion_window": COMPLETION_WINDOW}
+    return call_api("POST", f"{api_base}/batches", api_key, json=payload).json()
+
+def get_batch(api_base, api_key, batch_id):
+    return call_api("GET", f"{api_base}/batches/{batch_id}", api_key).json()
+
+def download_file(api_base, api_key, file_id):
+    response = call_api("GET", f"{api_base}/files/{file_id}/content", api_key)
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+def get_pending_requests(model_api, model, tasks, table, journals, cache, prefix_caching, on_cached, duplicates, api_base=None):
+    lines = []
+    sent = set()
+    for task_position, task in enumerate(tasks):
+        for index, prompt in enumerate(render_prompts(table, task)):
+            if index in journals[task]:
+                continue
+            if index in duplicates:
+                if (task, duplicates[index][0]) in sent:
+                    continue
+                sent.add((task, duplicates[index][0]))
+
+            response = cache.get(get_cache_key(model_api, model, prompt, prefix_caching, api_base)) if cache else None
+            if response is None:
+                line = get_batch_request(model_api, model, prompt, get_custom_id(task_position, index), prefix_caching)
+                lines.append((json.dumps(line) + "\n").encode("utf-8"))
+            else:
+                on_cached(task, index, prompt, response)
+    return lines
+
+def run_batch_predictions(model_api, model, tasks, prompt_file_path, api_key, api_base=None, cache=None, prefix_caching=False,
+                          map_renderer="canvas", poll_interval=POLL_INTERVAL, wait=True, resubmit=False,
+                          max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES, verbose=False, max_resubmits=MAX_RESUBMITS):
+    """Runs the prompts through the provider's batch API, with the same journals and outputs as run_tasks_for_data.
+
+    Batch files, uploads, batch ids and collected results are recorded in a state file next to the results after every
+    step, so the run can be stopped at any point (or submitted with wait=False) and resumed by calling it again.
+    Returns the summary once every batch has been collected, and None otherwise.
+    """
+    api_base = api_base or API_BASES[model_api]
+    table = load_prompt_table(prompt_file_path)
+    num_prompts = len(table["texts"])
+    duplicates = find_duplicate_groups(table["latitudes"], table["longitudes"], table["texts"])
+    if duplicates:
+        print(f"Prompts: {describe_duplicates(num_prompts, count_unique(num_prompts, duplicates))}. Identical prompts are only sent once.")
+    run_file_path, base_file_paths = get_output_paths(model, tasks, prompt_file_path)
+    state_file, batches_dir = f"{run_file_path}_batches.json", f"{run_file_path}.batches"
+    usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+    journals = {task: Journal(f"{base_file_paths[task]}.journal.jsonl") for task in tasks}
+    try:
+        def store_response(task, index, prompt, response, from_cache=False):
+            if cache and not from_cache:
+                cache.put(get_cache_key(model_api, model, prompt, prefix_caching, api_base), response)
+            if not from_cache:
+                add_usage(usage, response)
+            record_prediction(journals[task], table, task, index, prompt, response, verbose, duplicates.get(index, ()))
+
+        def on_cached(task, index, prompt, response):
+            store_response(task, index, prompt, response, from_cache=True)
+
+        state = read_json(state_file)
+        settings = {"model_api": model_api, "model": model, "prompts_file": prompt_file_path, "tasks": tasks, "prefix_caching": prefix_caching}
+        if state is None:
+            lines = get_pending_requests(model_api, model, tasks, table, journals, cache, prefix_caching, on_cached, duplicates, api_base)
+            state = {**settings, "created_at": time.time(), "batches": write_batch_files(lines, batches_dir, 0, max_requests, max_bytes)}
+            write_json(state_file, state)
+            print(f"Wrote {len(lines)} requests to {len(state['batches'])} batch files in {batches_dir}")
+        elif any(state[key] != value for key, value in settings.items()):
+            raise ValueError(f"{state_file} belongs to a different run ({', '.join(f'{key}={state[key]}' for key in settings)}). Delete it to start over.")
+
+        def collect(entry):
+            prompts = {}
+            for file_id in [entry["output_file_id"], entry["error_file_id"]]:
+                if not file_id:
+                    continue
+                for line in download_file(api_base, api_key, file_id):
+                    task_position, index = parse_custom_id(line["custom_id"])
+                    task = tasks[task_position]
+                    response = line.get("response") or {}
+                    if index in journals[task] or response.get("status_code") != 200:
+                        continue
+                    if task not in prompts:
+                        prompts[task] = render_prompts(table, task)
+                    store_response(task, index, prompts[task][index], parse_chat_response(response["body"]))
+            entry["collected"] = True
+
+        while True:
+            for entry in state["batches"]:
+                if entry["collected"]:
+                    continue
+                if entry["input_file_id"] is None:
+                    entry["input_file_id"] = upload_file(api_base, api_key, entry["file"])
+                    write_json(state_file, state)
+                if entry["batch_id"] is None:
+                    batch = create_batch(api_base, api_key, entry["input_file_id"])
+                    entry["batch_id"], entry["status"] = batch["id"], batch["status"]
+                    write_json(state_file, state)
+                    print(f"Submitted {entry['file']} as {entry['batch_id']} ({entry['requests']} requests)")
+
+                batch = get_batch(api_base, api_key, entry["batch_id"])
+                entry.update(status=batch["status"], output_file_id=batch.get("output_file_id"), error_file_id=batch.get("error_file_id"),
+                             request_counts=batch.get("request_counts"))
+                if entry["status"] in FINAL_STATUSES:
+                    collect(entry)
+                    counts = entry.get("request_counts") or {}
+                    print(f"{entry['batch_id']} {entry['status']}: {counts.get('completed', 0)} completed, {counts.get('failed', 0)} failed")
+                write_json(state_file, state)
+
+            remaining = [entry for entry in state["batches"] if not entry["collected"]]
+            if not remaining:
+                missing = sum(num_prompts - len(journals[task]) for task in tasks)
+                if not missing or not resubmit:
+                    if missing:
+                        print(f"{missing} prompts failed or expired. Rerun with --resubmit to send them in new batches.")
+                    break
+                if state.get("resubmits", 0) >= max_resubmits:
+                    for task in tasks:
+                        indices = [index for index in range(num_prompts) if index not in journals[task]]
+                        if indices:
+                            print(f"{task}: {len(indices)} prompts still failed after {max_resubmits} resubmissions: {', '.join(map(str, indices[:20]))}{', ...' if len(indices) > 20 else ''}")
+                    break
+                state["resubmits"] = state.get("resubmits", 0) + 1
+
+                lines = get_pending_requests(model_api, model, tasks, table, journals, cache, prefix_caching, on_cached, duplicates, api_base)
+                state["batches"] += write_batch_files(lines, batches_dir, len(state["batches"]), max_requests, max_bytes)
+                write_json(state_file, state)
+                print(f"Resubmitting {len(lines)} prompts ({state['resubmits']} of {max_resubmits})")
+                continue
+
+            if not wait:
+                print(f"{len(remaining)} batches are still running. Rerun the same command to collect them.")
+                return None
+
+            print(f"Waiting for {len(remaining)} batches: {', '.join(sorted(set(entry['status'] for entry in remaining)))}")
+            time.sleep(poll_interval)
+    finally:
+        for journal in journals.values():
+            journal.close()
+
+    write_usage(usage, time.time() - state["created_at"], prefix_caching, f"{run_file_path}_usage.jsonl")
+    return write_summary(journals, base_file_paths, num_prompts, map_renderer, f"{run_file_path}_summary.csv")
+
+def main():
+    parser = argparse.ArgumentParser(description='Run zero-shot predictions through a provider batch API.')
+    parser.add_argument('model_api', type=str, choices=sorted(API_BASES), help='The API to use for predictions')
+    parser.add_argument('api_key', type=str, help='The API key')
+    parser.add_argument('model', type=str, help='The model to use for predictions')
+    parser.add_argument('prompts_file', type=str, help='The file containing prompts')
+    parser.add_argument('tasks', type=str, nargs='+', help='One or more tasks for predictions')
+    parser.add_argument('--api_base', type=str, help='Override the provider base URL (e.g. the fake server in fake_servers.py)')
+    parser.add_argument('--poll_interval', type=float, default=POLL_INTERVAL, help='Seconds between batch status checks')
+    parser.add_argument('--no_wait', action='store_true', help='Submit the batches (or collect the finished ones) and exit instead of waiting for all of them')
+    parser.add_argument('--resubmit', action='store_true', help='Send prompts from failed or expired requests in new batches')
+    parser.add_argument('--max_resubmits', type=int, default=MAX_RESUBMITS, help='Maximum number of rounds of new batches for failed prompts with --resubmit')
+    parser.add_argument('--max_requests', type=int, default=MAX_BATCH_REQUESTS, help='Maximum number of requests per batch')
+    parser.add_argument('--max_mb', type=float, default=MAX_BATCH_BYTES / 1024 ** 2, help='Maximum size of a batch file in MB')
+    parser.add_argument('--cache', type=str, default=CACHE_FILE, help='Path to the on-disk response cache')
+    parser.add_argument('--no_cache', action='store_true', help='Do not read from or write to the response cache')
+    parser.add_argument('--prefix_caching', action='store_true', help='Send the constant instructions at the start of every prompt as a separate system message')
+    parser.add_argument('--verbose', action='store_true', help='Print every prompt and completion')
+    parser.add_argument('--metrics_interval', type=float, default=REPORT_INTERVAL, help='Seconds between progress lines (0 to disable)')
+    parser.add_argument('--map_renderer', type=str, default='canvas', choices=sorted(RENDERERS), help='How to draw the prediction maps')
+
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else DiskCache(args.cache)
+
+    try:
+        with MetricsReporter(args.metrics_interval):
+            run_batch_predictions(
+                args.model_api, args.model, args.tasks, args.prompts_file, args.api_key,
+                api_base=args.api_base,
+                cache=cache,
+                prefix_caching=args.prefix_caching,
+                map_renderer=args.map_renderer,
+                poll_interval=args.poll_interval,
+                wait=not args.no_wait,
+                resubmit=args.resubmit,
+                max_requests=args.max_requests,
+                max_bytes=int(args.max_mb * 1024 ** 2),
+                verbose=args.verbose,
+                max_resubmits=args.max_resubmits
+            )
+    finally:
+        if cache:
+            cache.close()
+
+if __name__ == "__main__":
+    main()
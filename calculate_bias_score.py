@@ -1,20 +1,11 @@
 import argparse
-import numpy as np
 import pandas as pd
 from utils import *
-from scipy.stats import spearmanr
+import metrics
 
 def calculate_bias_score(coordinates, predictions, groundtruth_tif, num_prompts):
-    groundtruth = [extract_data(lat, lon, groundtruth_tif) for lat, lon in coordinates]
-    corr, _ = spearmanr(predictions, groundtruth)
-
-    MAD_of_predictions = np.mean(np.abs(predictions - np.mean(predictions)))
-
-    answer_rate = len(predictions) / num_prompts
-
-    bias_score = corr * MAD_of_predictions * answer_rate
-
-    return bias_score
+    groundtruth = extract_data_batch(coordinates, groundtruth_tif)
+    return metrics.bias_score(predictions, groundtruth, num_prompts)
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluate predictions")
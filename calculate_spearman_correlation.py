@@ -1,12 +1,11 @@
 import argparse
 import pandas as pd
 from utils import *
-from scipy.stats import spearmanr
+import metrics
 
 def calculate_spearman_correlation(coordinates, predictions, groundtruth_tif):
-    groundtruth = [extract_data(lat, lon, groundtruth_tif) for lat, lon in coordinates]
-    corr, _ = spearmanr(predictions, groundtruth)
-    return corr
+    groundtruth = extract_data_batch(coordinates, groundtruth_tif)
+    return metrics.spearman_correlation(predictions, groundtruth)
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluate predictions")
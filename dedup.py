@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from prompt_shards import write_json
+from utils import load_prompt_table
+
+COORDINATE_PRECISION = 5
+
+def geohash_bits(latitudes, longitudes, length):
+    """Geohashes of `length` characters as integers (5 bits per character, longitude first)."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = (np.asarray(longitudes, dtype=np.float64) + 180) % 360 - 180
+    bits = 5 * length
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lon_cells = np.clip(((longitudes + 180) / 360 * 2 ** lon_bits).astype(np.int64), 0, 2 ** lon_bits - 1)
+    lat_cells = np.clip(((latitudes + 90) / 180 * 2 ** lat_bits).astype(np.int64), 0, 2 ** lat_bits - 1)
+
+    hashes = np.zeros(len(latitudes), dtype=np.int64)
+    for bit in range(bits):
+        if bit % 2 == 0:
+            value = (lon_cells >> (lon_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_cells >> (lat_bits - 1 - bit // 2)) & 1
+        hashes = (hashes << 1) | value
+    return hashes
+
+def rounded(values, precision):
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    return np.char.mod(f"%.{precision}f", values).astype(np.float64) if len(values) else values
+
+def get_location_keys(latitudes, longitudes, precision=COORDINATE_PRECISION, geohash_length=None):
+    """One integer per location: the coordinates rounded to `precision` decimals, or the geohash cell of
+    `geohash_length` characters (at most 12) if it is given.
+
+    Coordinates are rounded the way they are formatted in the prompts, so a prompt's coordinates get the same key as
+    the coordinates it was generated from.
+    """
+    if geohash_length:
+        return geohash_bits(latitudes, longitudes, geohash_length)
+    scale = 10 ** precision
+    lat = np.rint(rounded(latitudes, precision) * scale).astype(np.int64) + 90 * scale
+    lon = np.rint(rounded(longitudes, precision) * scale).astype(np.int64) + 180 * scale
+    return lat * (360 * scale + 1) + lon
+
+def find_duplicates(keys):
+    """The index of the first row of every unique key (in order of appearance) and, for every row, the position of its
+    key among them."""
+    keys = np.asarray(keys)
+    if not len(keys):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    positions = np.empty_like(order)
+    positions[order] = np.arange(len(order))
+    return first[order], positions[inverse.reshape(-1)]
+
+def find_duplicate_groups(latitudes, longitudes, texts=None, precision=COORDINATE_PRECISION, geohash_length=None):
+    """Maps every row that shares its location (and text, if `texts` are given) with another row to the indices of
+    all of them, in order. Rows without duplicates are left out."""
+    keys = get_location_keys(latitudes, longitudes, precision, geohash_length)
+    _, inverse = find_duplicates(keys)
+    counts = np.bincount(inverse) if len(inverse) else np.zeros(0, dtype=np.int64)
+
+    groups = {}
+    for index in np.nonzero(counts[inverse] > 1)[0].tolist():
+        key = (int(inverse[index]), texts[index] if texts is not None else None)
+        groups.setdefault(key, []).append(index)
+
+    return {index: group for group in map(tuple, groups.values()) if len(group) > 1 for index in group}
+
+def count_unique(num_rows, groups):
+    """Number of unique rows, given the groups returned by find_duplicate_groups."""
+    return num_rows - len(groups) + len({group[0] for group in groups.values()})
+
+def describe_duplicates(num_rows, num_unique):
+    duplicates = num_rows - num_unique
+    return f"{num_rows} rows, {num_unique} unique locations, {duplicates} duplicates ({duplicates / num_rows if num_rows else 0.0:.1%} duplication ratio)"
+
+def load_locations(file_path):
+    """Latitudes, longitudes and the rows of a csv with 'Latitude' and 'Longitude' columns (coordinates or predictions)
+    as a DataFrame, or of a prompt file or store as prompt texts."""
+    if file_path.endswith(".csv"):
+        df = pd.read_csv(file_path)
+        if 'Latitude' not in df.columns or 'Longitude' not in df.columns:
+            raise ValueError(f"{file_path} must contain 'Latitude' and 'Longitude' columns")
+        return df['Latitude'].to_numpy(dtype=np.float64), df['Longitude'].to_numpy(dtype=np.float64), df
+
+    table = load_prompt_table(file_path)
+    return np.asarray(table["latitudes"]), np.asarray(table["longitudes"]), table["texts"]
+
+def write_prompt_texts(texts, file_path):
+    temporary_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as file:
+        for text in texts:
+            file.write(json.dumps({"text": text}) + "\n")
+    os.replace(temporary_path, file_path)
+
+def write_unique(input_files, output_file, precision=COORDINATE_PRECISION, geohash_length=None):
+    """Writes the first row of every unique location across `input_files` (all coordinate csvs or all prompt files)
+    to `output_file`, and a report with the duplication ratio of every input next to it."""
+    are_csvs = [file_path.endswith(".csv") for file_path in input_files]
+    if any(are_csvs) and not all(are_csvs):
+        raise ValueError("Inputs must be either all coordinate csvs or all prompt files")
+
+    inputs = [load_locations(file_path) for file_path in input_files]
+    latitudes = np.concatenate([latitudes for latitudes, _, _ in inputs])
+    longitudes = np.concatenate([longitudes for _, longitudes, _ in inputs])
+    first, _ = find_duplicates(get_location_keys(latitudes, longitudes, precision, geohash_length))
+
+    report = {"precision": precision, "geohash_length": geohash_length, "inputs": []}
+    for file_path, (file_latitudes, file_longitudes, _) in zip(input_files, inputs):
+        unique, _ = find_duplicates(get_location_keys(file_latitudes, file_longitudes, precision, geohash_length))
+        report["inputs"].append({"file": file_path, "rows": len(file_latitudes), "unique": len(unique)})
+        print(f"{file_path}: {describe_duplicates(len(file_latitudes), len(unique))}")
+
+    offsets = np.cumsum([0] + [len(file_latitudes) for file_latitudes, _, _ in inputs])
+    sources = np.searchsorted(offsets, first, side="right") - 1
+    if all(are_csvs):
+        rows = [inputs[source][2].iloc[first[sources == source] - offsets[source]] for source in range(len(inputs))]
+        pd.concat(rows, ignore_index=True).to_csv(output_file, index=False)
+    else:
+        write_prompt_texts((inputs[source][2][int(index - offsets[source])] for source, index in zip(sources, first)), output_file)
+
+    report.update({"output": output_file, "rows": len(latitudes), "unique": len(first), "duplication_ratio": 1 - len(first) / len(latitudes) if len(latitudes) else 0.0})
+    write_json(f"{output_file}.dedup.json", report)
+    print(f"Total: {describe_duplicates(len(latitudes), len(first))}. Wrote the unique locations to {output_file}")
+    return report
+
+def fan_out(results_file, input_files, output_dir, precision=COORDINATE_PRECISION, geohash_length=None):
+    """Copies the result of every unique location in `results_file` (prompts generated from a unique coordinate csv,
+    or predictions for a unique prompt file) to every row of `input_files` at that location. Writes one file per input
+    to `output_dir` and returns their paths."""
+    result_latitudes, result_longitudes, results = load_locations(results_file)
+    result_keys = get_location_keys(result_latitudes, result_longitudes, precision, geohash_length)
+    positions = {key: position for position, key in reversed(list(enumerate(result_keys.tolist())))}
+    is_csv = results_file.endswith(".csv")
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    output_files = []
+    for position, input_file in enumerate(input_files):
+        latitudes, longitudes, _ = load_locations(input_file)
+        keys = get_location_keys(latitudes, longitudes, precision, geohash_length).tolist()
+        rows = [(index, positions[key]) for index, key in enumerate(keys) if key in positions]
+
+        name = os.path.splitext(os.path.basename(os.path.normpath(input_file)))[0]
+        if any(os.path.splitext(os.path.basename(os.path.normpath(other)))[0] == name for other in input_files[:position]):
+            name = f"{name}_{position}"
+        if is_csv:
+            output_file = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(results_file))[0]}_{name}.csv")
+            df = results.iloc[[position for _, position in rows]].reset_index(drop=True)
+            df['Latitude'] = latitudes[[index for index, _ in rows]]
+            df['Longitude'] = longitudes[[index for index, _ in rows]]
+            df.to_csv(output_file, index=False)
+        else:
+            output_file = os.path.join(output_dir, f"{name}.jsonl")
+            write_prompt_texts((results[position] for _, position in rows), output_file)
+
+        print(f"{input_file}: {len(rows)} of {len(keys)} rows have a result, written to {output_file}")
+        output_files.append(output_file)
+
+    return output_files
+
+def main():
+    parser = argparse.ArgumentParser(description="Find duplicate locations across coordinate csvs or prompt files, so every location is geocoded and predicted once, and copy the results back to every original row.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    unique_parser = subparsers.add_parser("unique", help="Write the unique locations of the inputs to one file and report the duplication ratio.")
+    unique_parser.add_argument("inputs", type=str, nargs="+", help="Coordinate csvs (with 'Latitude' and 'Longitude' columns), or prompt files or stores.")
+    unique_parser.add_argument("--output", type=str, required=True, help="Where to write the unique coordinates (csv) or prompts (jsonl).")
+
+    fan_out_parser = subparsers.add_parser("fan_out", help="Copy the results for the unique locations to every row of the inputs.")
+    fan_out_parser.add_argument("results", type=str, help="Prompts generated for the unique coordinates, or a predictions csv for the unique prompts.")
+    fan_out_parser.add_argument("inputs", type=str, nargs="+", help="The original coordinate csvs or prompt files.")
+    fan_out_parser.add_argument("--output_dir", type=str, help="Folder for the per-input results. Defaults to prompts/ for prompts and results/ for predictions.")
+
+    for subparser in (unique_parser, fan_out_parser):
+        subparser.add_argument("--precision", type=int, default=COORDINATE_PRECISION, help="Coordinates that round to the same number of decimals are the same location.")
+        subparser.add_argument("--geohash_length", type=int, help="Key locations on geohash cells of this many characters (at most 12) instead of rounded coordinates.")
+
+    args = parser.parse_args()
+
+    if args.geohash_length and not 1 <= args.geohash_length <= 12:
+        parser.error("--geohash_length must be between 1 and 12")
+
+    if args.command == "unique":
+        write_unique(args.inputs, args.output, args.precision, args.geohash_length)
+    else:
+        output_dir = args.output_dir or ("results" if args.results.endswith(".csv") else "prompts")
+        fan_out(args.results, args.inputs, output_dir, args.precision, args.geohash_length)
+
+if __name__ == "__main__":
+    main()
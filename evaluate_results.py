@@ -0,0 +1,165 @@
+import argparse
+import glob
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import metrics
+from cache import make_cache_key
+from utils import extract_data_batch
+
+COORDINATE_PRECISION = 5
+SAMPLES_CACHE_DIR = "cache/groundtruth"
+REQUIRED_COLUMNS = ['Latitude', 'Longitude', 'Predictions']
+
+def coordinate_keys(latitudes, longitudes):
+    scale = 10 ** COORDINATE_PRECISION
+    lat = np.round(np.asarray(latitudes, dtype=np.float64) * scale).astype(np.int64) + 90 * scale
+    lon = np.round(np.asarray(longitudes, dtype=np.float64) * scale).astype(np.int64) + 180 * scale
+    return lat * (360 * scale + 1) + lon
+
+def keys_to_coordinates(keys):
+    scale = 10 ** COORDINATE_PRECISION
+    lat, lon = np.divmod(keys, 360 * scale + 1)
+    return np.column_stack([(lat - 90 * scale) / scale, (lon - 180 * scale) / scale])
+
+def load_results(results_dir):
+    results = {}
+    for file_path in sorted(glob.glob(os.path.join(results_dir, "*.csv"))):
+        # Interpolated surfaces from adaptive_predictions.py have the same columns but are not model predictions.
+        if file_path.endswith("_adaptive.csv"):
+            continue
+        df = pd.read_csv(file_path)
+        if not all(column in df.columns for column in REQUIRED_COLUMNS):
+            continue
+        results[file_path] = (coordinate_keys(df['Latitude'], df['Longitude']), df['Predictions'].to_numpy(dtype=np.float64))
+    return results
+
+def load_num_prompts(results_dir):
+    num_prompts = {}
+    for file_path in glob.glob(os.path.join(results_dir, "*_summary.csv")):
+        df = pd.read_csv(file_path)
+        if 'Predictions File' not in df.columns or 'Prompts' not in df.columns:
+            continue
+        for predictions_file, prompts in zip(df['Predictions File'], df['Prompts']):
+            name = os.path.basename(predictions_file)
+            num_prompts[name] = prompts
+            num_prompts[name.replace(".csv", "_expected_value.csv")] = prompts
+    return num_prompts
+
+def get_samples_cache_path(groundtruth_tif, cache_dir):
+    stat = os.stat(groundtruth_tif)
+    key = make_cache_key(os.path.abspath(groundtruth_tif), stat.st_mtime_ns, stat.st_size)
+    return os.path.join(cache_dir, f"{key}.npz")
+
+def sample_groundtruth(groundtruth_tif, keys, cache_dir=SAMPLES_CACHE_DIR):
+    """Ground truth at each of the (sorted, unique) coordinate keys, sampling only keys not already cached on disk."""
+    cached_keys, cached_values = np.zeros(0, dtype=np.int64), np.zeros(0)
+    cache_path = get_samples_cache_path(groundtruth_tif, cache_dir) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            cached_keys, cached_values = cached['keys'], cached['values']
+
+    missing = keys[~np.isin(keys, cached_keys)]
+    if len(missing):
+        cached_keys = np.concatenate([cached_keys, missing])
+        cached_values = np.concatenate([cached_values, extract_data_batch(keys_to_coordinates(missing), groundtruth_tif)])
+        order = np.argsort(cached_keys)
+        cached_keys, cached_values = cached_keys[order], cached_values[order]
+
+        if cache_path:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            temporary_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(temporary_path, keys=cached_keys, values=cached_values)
+            os.replace(temporary_path, cache_path)
+
+    return cached_values[np.searchsorted(cached_keys, keys)], len(missing)
+
+def group_by_coordinate_set(results):
+    groups = {}
+    for file_path, (keys, _) in results.items():
+        digest = hashlib.sha256(np.sort(keys).tobytes()).hexdigest()
+        groups.setdefault(digest, []).append(file_path)
+    return list(groups.values())
+
+def evaluate_group(file_paths, results, unique_keys, groundtruth, num_prompts):
+    keys = results[file_paths[0]][0]
+    rows = np.searchsorted(unique_keys, keys)
+    predictions = np.full((len(keys), len(file_paths)), np.nan)
+    order = np.argsort(keys, kind="stable")
+    for column, file_path in enumerate(file_paths):
+        file_keys, file_predictions = results[file_path]
+        predictions[order, column] = file_predictions[np.argsort(file_keys, kind="stable")]
+
+    prompts = np.array([num_prompts.get(os.path.basename(file_path), np.nan) for file_path in file_paths], dtype=np.float64)
+    rates = metrics.answer_rate(predictions, prompts)
+    mad = metrics.mean_absolute_deviation(predictions)
+
+    rows_by_tif = []
+    for groundtruth_tif, values in groundtruth.items():
+        corr = metrics.spearman_correlation(predictions, values[rows])
+        bias = metrics.bias_score(predictions, values[rows], prompts)
+        for column, file_path in enumerate(file_paths):
+            rows_by_tif.append({
+                "Predictions File": file_path,
+                "Ground Truth": groundtruth_tif,
+                "Rows": len(keys),
+                "Prompts": prompts[column],
+                "Answer Rate": rates[column],
+                "Spearman": corr[column],
+                "MAD": mad[column],
+                "Bias Score": bias[column]
+            })
+    return rows_by_tif
+
+def evaluate_results(results_dir, groundtruth_tifs, num_prompts=None, cache_dir=SAMPLES_CACHE_DIR, workers=None):
+    results = load_results(results_dir)
+    if not results:
+        raise ValueError(f"No csv files with {', '.join(REQUIRED_COLUMNS)} columns found in {results_dir}")
+
+    prompts_by_file = load_num_prompts(results_dir)
+    if num_prompts is not None:
+        prompts_by_file = {os.path.basename(file_path): num_prompts for file_path in results}
+
+    unique_keys = np.unique(np.concatenate([keys for keys, _ in results.values()]))
+    groups = group_by_coordinate_set(results)
+    print(f"{len(results)} result files, {len(groups)} coordinate sets, {len(unique_keys)} unique coordinates")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        samples = dict(zip(groundtruth_tifs, executor.map(lambda tif: sample_groundtruth(tif, unique_keys, cache_dir), groundtruth_tifs)))
+        for groundtruth_tif, (_, sampled) in samples.items():
+            print(f"{groundtruth_tif}: sampled {sampled} coordinates, {len(unique_keys) - sampled} from cache")
+        groundtruth = {groundtruth_tif: values for groundtruth_tif, (values, _) in samples.items()}
+
+        evaluations = executor.map(lambda file_paths: evaluate_group(file_paths, results, unique_keys, groundtruth, prompts_by_file), groups)
+        summary = pd.DataFrame([row for rows in evaluations for row in rows])
+
+    return summary.sort_values(["Ground Truth", "Predictions File"], ignore_index=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Score every predictions csv in a results folder against one or more ground truth rasters.")
+    parser.add_argument("groundtruth_tifs", type=str, nargs='+', help="Paths to the ground truth (or anchoring distribution) tif files.")
+    parser.add_argument("--results_dir", type=str, default="results", help="Folder with the predictions csv files.")
+    parser.add_argument("--output", type=str, default="results/evaluation.csv", help="Where to write the summary table.")
+    parser.add_argument("--num_prompts", type=int, help="Number of prompts behind every predictions file. By default this is read from the *_summary.csv files in the results folder.")
+    parser.add_argument("--cache_dir", type=str, default=SAMPLES_CACHE_DIR, help="Folder for cached ground truth samples.")
+    parser.add_argument("--no_cache", action='store_true', help="Do not read or write cached ground truth samples.")
+    parser.add_argument("--workers", type=int, help="Number of threads used to sample rasters and score coordinate sets.")
+
+    args = parser.parse_args()
+
+    summary = evaluate_results(
+        args.results_dir,
+        args.groundtruth_tifs,
+        num_prompts=args.num_prompts,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        workers=args.workers
+    )
+    summary.to_csv(args.output, index=False)
+
+    print(summary.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+import time
+import requests
+from aiohttp import web
+
+DEFAULT_PORT = 8799
+MAX_UPLOAD_BYTES = 256 * 1024 ** 2
+DIGITS = "0123456789"
+
+def get_seed(*parts):
+    return int(hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()[:16], 16)
+
+def get_fake_address(lat, lon):
+    rng = random.Random(get_seed("address", round(lat, 5), round(lon, 5)))
+    return {
+        "house_number": str(rng.randint(1, 999)),
+        "road": f"{rng.choice(['Main', 'Church', 'Market', 'River', 'Station'])} {rng.choice(['Street', 'Road', 'Avenue'])}",
+        "suburb": f"District {rng.randint(1, 40)}",
+        "city": f"City {rng.randint(1, 5000)}",
+        "state": f"Region {rng.randint(1, 60)}",
+        "postcode": str(rng.randint(10000, 99999)),
+        "country": f"Country {rng.randint(1, 200)}",
+        "country_code": "xx"
+    }
+
+def get_fake_places(lat, lon, radius_in_km):
+    rng = random.Random(get_seed("places", round(lat, 5), round(lon, 5)))
+    elements = []
+    for index in range(rng.randint(0, 40)):
+        distance = radius_in_km * math.sqrt(rng.random())
+        bearing = rng.uniform(0, 2 * math.pi)
+        elements.append({
+            "type": "node",
+            "id": index,
+            "lat": lat + distance / 111.0 * math.cos(bearing),
+            "lon": lon + distance / (111.0 * max(math.cos(math.radians(lat)), 0.01)) * math.sin(bearing),
+            "tags": {"name": f"Place {rng.randint(1, 100000)}", "place": rng.choice(["city", "town", "village", "hamlet"])}
+        })
+    return {"elements": elements}
+
+def get_fake_completion(prompt):
+    rng = random.Random(get_seed("completion", prompt))
+    integer, decimal = rng.randint(0, 9), rng.randint(0, 9)
+
+    def digit_entry(digit):
+        weights = [rng.random() ** 4 for _ in DIGITS]
+        weights[digit] = max(weights) + 1.0
+        total = sum(weights)
+        top = sorted(range(10), key=lambda index: -weights[index])[:5]
+        return {
+            "token": DIGITS[digit],
+            "logprob": math.log(weights[digit] / total),
+            "top_logprobs": [{"token": DIGITS[index], "logprob": math.log(weights[index] / total)} for index in top]
+        }
+
+    tokens = [{"token": token, "logprob": 0.0, "top_logprobs": []} for token in ["My", " answer", " is", " "]]
+    tokens += [digit_entry(integer), {"token": ".", "logprob": 0.0, "top_logprobs": []}, digit_entry(decimal), {"token": ".", "logprob": 0.0, "top_logprobs": []}]
+    return f"My answer is {integer}.{decimal}.", tokens
+
+def get_chat_completion(body):
+    prompt = "\n".join(message["content"] for message in body["messages"])
+    completion, tokens = get_fake_completion(prompt)
+    return {
+        "object": "chat.completion",
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "logprobs": {"content": tokens}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(tokens), "prompt_tokens_details": {"cached_tokens": 0}}
+    }
+
+class FakeServer:
+    """Stands in for Nominatim, Overpass and an OpenAI-compatible chat completions and batch API."""
+
+    def __init__(self, latency_ms=20.0, jitter_ms=10.0, error_rate=0.0, retry_after=0.05, batch_seconds=2.0, seed=0,
+                 slow_rate=0.0, slow_ms=1000.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.batch_seconds = batch_seconds
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.batches = {}
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.errors = {}
+        self.latencies = {}
+
+    async def respond(self, endpoint, handler):
+        start_time = time.perf_counter()
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        slow_ms = self.slow_ms if self.rng.random() < self.slow_rate else 0.0
+        await asyncio.sleep((self.latency_ms + self.rng.uniform(0, self.jitter_ms) + slow_ms) / 1000)
+
+        if self.rng.random() < self.error_rate:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            response = web.Response(status=429, text="Too Many Requests", headers={"Retry-After": str(self.retry_after)})
+        else:
+            response = await handler()
+
+        self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start_time)
+        return response
+
+    async def reverse(self, request):
+        async def handler():
+            lat, lon = float(request.query["lat"]), float(request.query["lon"])
+            return web.json_response({"address": get_fake_address(lat, lon)})
+        return await self.respond("nominatim", handler)
+
+    async def interpreter(self, request):
+        async def handler():
+            query = (await request.post())["data"]
+            around = query.split("around:")[1].split(")")[0]
+            radius, lat, lon = map(float, around.split(","))
+            return web.json_response(get_fake_places(lat, lon, radius / 1000))
+        return await self.respond("overpass", handler)
+
+    async def chat_completions(self, request):
+        async def handler():
+            return web.json_response(get_chat_completion(await request.json()))
+        return await self.respond("openai", handler)
+
+    def add_file(self, content, purpose):
+        file_id = f"file-{len(self.files) + 1:06d}"
+        self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "purpose": purpose}
+
+    async def upload_file(self, request):
+        async def handler():
+            form = await request.post()
+            return web.json_response(self.add_file(form["file"].file.read(), form["purpose"]))
+        return await self.respond("batch", handler)
+
+    async def file_content(self, request):
+        async def handler():
+            file_id = request.match_info["file_id"]
+            if file_id not in self.files:
+                return web.json_response({"error": {"message": f"No such file: {file_id}"}}, status=404)
+            return web.Response(body=self.files[file_id], content_type="application/jsonl")
+        return await self.respond("batch", handler)
+
+    async def run_batch(self, batch):
+        batch["status"] = "in_progress"
+        await asyncio.sleep(self.batch_seconds)
+
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode("utf-8").splitlines():
+            item = json.loads(line)
+            if self.rng.random() < self.error_rate:
+                response = {"status_code": 429, "body": {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}}}
+                errors.append({"id": f"response-{item['custom_id']}", "custom_id": item["custom_id"], "response": response, "error": None})
+            else:
+                response = {"status_code": 200, "body": get_chat_completion(item["body"])}
+                outputs.append({"id": f"response-{item['custom_id']}", "custom_id": item["custom_id"], "response": response, "error": None})
+
+        for key, lines in [("output_file_id", outputs), ("error_file_id", errors)]:
+            if lines:
+                batch[key] = self.add_file("".join(json.dumps(line) + "\n" for line in lines).encode("utf-8"), "batch_output")["id"]
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+    async def create_batch(self, request):
+        async def handler():
+            body = await request.json()
+            if body.get("input_file_id") not in self.files:
+                return web.json_response({"error": {"message": f"No such file: {body.get('input_file_id')}"}}, status=400)
+            batch_id = f"batch_{len(self.batches) + 1:06d}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "status": "validating",
+                "output_file_id": None,
+                "error_file_id": None,
+                "created_at": int(time.time()),
+                "request_counts": {"total": 0, "completed": 0, "failed": 0}
+            }
+            asyncio.get_running_loop().create_task(self.run_batch(self.batches[batch_id]))
+            return web.json_response(self.batches[batch_id])
+        return await self.respond("batch", handler)
+
+    async def get_batch(self, request):
+        async def handler():
+            batch_id = request.match_info["batch_id"]
+            if batch_id not in self.batches:
+                return web.json_response({"error": {"message": f"No such batch: {batch_id}"}}, status=404)
+            return web.json_response(self.batches[batch_id])
+        return await self.respond("batch", handler)
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests, "errors": self.errors, "latencies": self.latencies})
+
+    async def reset_stats(self, request):
+        self.reset()
+        return web.json_response({})
+
+    def get_app(self):
+        app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+        app.router.add_get("/reverse", self.reverse)
+        app.router.add_post("/api/interpreter", self.interpreter)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/files", self.upload_file)
+        app.router.add_get("/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/v1/batches", self.create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.get_batch)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_post("/reset", self.reset_stats)
+        return app
+
+def serve(port=DEFAULT_PORT, **kwargs):
+    web.run_app(FakeServer(**kwargs).get_app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+def start_fake_server(port=DEFAULT_PORT, timeout=10, **kwargs):
+    process = multiprocessing.Process(target=serve, kwargs={"port": port, **kwargs}, daemon=True)
+    process.start()
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return process
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.05)
+
+    process.terminate()
+    raise RuntimeError(f"Fake server did not start on port {port}")
+
+def get_urls(port=DEFAULT_PORT):
+    base = f"http://127.0.0.1:{port}"
+    return {"nominatim": f"{base}/reverse", "overpass": f"{base}/api/interpreter", "openai": f"{base}/v1", "stats": f"{base}/stats", "reset": f"{base}/reset"}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run fake Nominatim, Overpass and OpenAI (chat completions and batch) servers for benchmarks and offline testing.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on.")
+    parser.add_argument("--latency_ms", type=float, default=20.0, help="Base latency of every response.")
+    parser.add_argument("--jitter_ms", type=float, default=10.0, help="Random extra latency of up to this many milliseconds.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests that get a 429 response.")
+    parser.add_argument("--retry_after", type=float, default=0.05, help="Retry-After header (in seconds) sent with 429 responses.")
+    parser.add_argument("--slow_rate", type=float, default=0.0, help="Fraction of requests that take --slow_ms longer.")
+    parser.add_argument("--slow_ms", type=float, default=1000.0, help="Extra latency of the slow requests.")
+    parser.add_argument("--batch_seconds", type=float, default=2.0, help="Time it takes a batch to complete.")
+
+    args = parser.parse_args()
+
+    urls = get_urls(args.port)
+    print(f"Nominatim: {urls['nominatim']}\nOverpass: {urls['overpass']}\nOpenAI: {urls['openai']}")
+    serve(args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate, retry_after=args.retry_after, batch_seconds=args.batch_seconds, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+
+if __name__ == "__main__":
+    main()
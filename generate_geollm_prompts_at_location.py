@@ -2,33 +2,48 @@ import argparse
 import numpy as np
 import rasterio
 from rasterio.transform import rowcol
+from rasterio.windows import Window
 from generate_geollm_prompts_with_csv import get_prompts
 from select_visualization_prompts import select_spread_out_points_with_importance_sampling
 
-def generate_prompts(bbox, num_prompts, output_file):
-    with rasterio.open('data/ppp_2020_1km_Aggregated.tif') as src:
-        data = src.read(1)
+POPULATION_FILE = 'data/ppp_2020_1km_Aggregated.tif'
+BLOCK_ROWS = 1024
+
+def get_populated_points(file_path, bbox):
+    with rasterio.open(file_path) as src:
         transform = src.transform
-        
-        top_left = rowcol(transform, bbox[0], bbox[3])
-        bottom_right = rowcol(transform, bbox[2], bbox[1])
-        
-        data_cropped = data[top_left[0]:bottom_right[0], top_left[1]:bottom_right[1]]
-        
-        pop_flat_cropped = data_cropped.flatten()
-        
-        indices_cropped = np.nonzero(pop_flat_cropped > 0)[0]
-        
-        rows_cropped, cols_cropped = np.unravel_index(indices_cropped, data_cropped.shape)
-        
-        rows_adjusted = rows_cropped + top_left[0]
-        cols_adjusted = cols_cropped + top_left[1]
-        
-        valid_coords = [tuple(reversed(rasterio.transform.xy(transform, row, col))) for row, col in zip(rows_adjusted, cols_adjusted)]
-        populations = [data[row, col] for row, col in zip(rows_adjusted, cols_adjusted)]
-
-    selected_indices = select_spread_out_points_with_importance_sampling(valid_coords, populations, num_prompts)
-    valid_coords = [valid_coords[i] for i in selected_indices]
+
+        top, left = rowcol(transform, bbox[0], bbox[3])
+        bottom, right = rowcol(transform, bbox[2], bbox[1])
+        top, bottom = max(top, 0), min(bottom, src.height)
+        left, right = max(left, 0), min(right, src.width)
+        if right <= left or bottom <= top:
+            return np.empty((0, 2)), np.empty(0, dtype=np.float32)
+
+        rows, cols, populations = [], [], []
+        for row_start in range(top, bottom, BLOCK_ROWS):
+            window = Window(left, row_start, right - left, min(BLOCK_ROWS, bottom - row_start))
+            data = src.read(1, window=window)
+
+            block_rows, block_cols = np.nonzero(data > 0)
+            rows.append(block_rows + row_start)
+            cols.append(block_cols + left)
+            populations.append(data[block_rows, block_cols])
+
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+    populations = np.concatenate(populations) if populations else np.empty(0, dtype=np.float32)
+
+    lons, lats = transform * (cols + 0.5, rows + 0.5)
+    points = np.column_stack([lats, lons])
+
+    return points, populations
+
+def generate_prompts(bbox, num_prompts, output_file):
+    points, populations = get_populated_points(POPULATION_FILE, bbox)
+
+    selected_indices = select_spread_out_points_with_importance_sampling(points, populations, num_prompts)
+    valid_coords = [tuple(point) for point in points[selected_indices].tolist()]
     
     get_prompts(valid_coords, output_file)
 
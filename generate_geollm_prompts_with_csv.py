@@ -1,21 +1,59 @@
 import argparse
 import json
+import os
+import numpy as np
 import pandas as pd
 import requests
 import concurrent.futures
 import random
 import math
-import overpy
 import time
 from geopy.distance import geodesic
+from pyproj import Geod
+from sklearn.neighbors import BallTree
 from tqdm import tqdm
+from cache import DiskCache, make_cache_key
+from dedup import COORDINATE_PRECISION, count_unique, describe_duplicates, find_duplicate_groups
+from hedging import HEDGE_QUANTILE, MAX_HEDGE_FRACTION, Hedger, call_with_retries
+from instrumentation import REPORT_INTERVAL, RETRIES, ROWS_WRITTEN, MetricsReporter, Timer
+from journal import Journal
+from rate_limiting import RateLimiter
+from prompt_shards import merge_shards, run_shards
 
 MAXIMUM_NEARBY_PLACES = 10
 MAXIMUM_RADIUS_IN_KM = 100
+CANDIDATE_NEARBY_PLACES = 3 * MAXIMUM_NEARBY_PLACES
+EARTH_RADIUS_IN_KM = 6371.0088
+COMPASS_DIRECTIONS = ["North", "North-East", "East", "South-East", "South", "South-West", "West", "North-West"]
 
-MIN_DELAY = 1
 MAX_WORKERS = 10
 TIMEOUT = 30
+MAX_ATTEMPTS = 5
+MAX_RETRIES = 2
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/reverse"
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+GEOCODING_CACHE_FILE = "cache/geocoding.sqlite"
+
+# The public Nominatim allows at most one request per second. Only raise it if NOMINATIM_URL is self-hosted.
+NOMINATIM_REQUESTS_PER_MINUTE = 60
+OVERPASS_REQUESTS_PER_MINUTE = 600
+
+RATE_LIMITERS = {
+    "nominatim": RateLimiter(requests_per_minute=NOMINATIM_REQUESTS_PER_MINUTE),
+    "overpass": RateLimiter(requests_per_minute=OVERPASS_REQUESTS_PER_MINUTE)
+}
+
+HEDGERS = {
+    "nominatim": Hedger("nominatim"),
+    "overpass": Hedger("overpass")
+}
+
+RETRYABLE_ERRORS = (TimeoutError, requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError)
+
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=2 * MAX_WORKERS))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=2 * MAX_WORKERS))
 
 def calculate_initial_compass_bearing(lat1, lon1, lat2, lon2):
     if (lat1 == lat2) and (lon1 == lon2):
@@ -26,15 +64,15 @@ def calculate_initial_compass_bearing(lat1, lon1, lat2, lon2):
     return bearing
 
 def bearing_to_compass(bearing):
-    directions = ["North", "North-East", "East", "South-East", "South", "South-West", "West", "North-West"]
-    return directions[round(bearing/45) % 8]
+    return COMPASS_DIRECTIONS[round(bearing/45) % 8]
 
-def parse_places_data(result, lat, lon):
+def parse_places_data(elements, lat, lon):
     places = []
-    for node in result.nodes:
-        if "place" in node.tags:
-            place_name = node.tags.get("name", "n/a")
-            place_lat, place_lon = float(node.lat), float(node.lon)
+    for node in elements:
+        tags = node.get("tags", {})
+        if node.get("type") == "node" and "place" in tags:
+            place_name = tags.get("name", "n/a")
+            place_lat, place_lon = float(node["lat"]), float(node["lon"])
             distance = geodesic((lat, lon), (place_lat, place_lon)).km
             bearing = calculate_initial_compass_bearing(math.radians(lat), math.radians(lon), math.radians(place_lat), math.radians(place_lon))
             compass_direction = bearing_to_compass(bearing)
@@ -42,98 +80,272 @@ def parse_places_data(result, lat, lon):
     places.sort(key=lambda x: x[1])
     return places
 
-def get_nearby_places(lat, lon):
+def format_nearby_places(places):
+    nearby_places = ""
+    for place in places[:MAXIMUM_NEARBY_PLACES]:
+        nearby_places += f"{place[1]:.1f} km {place[2]}: {place[0]}\n"
+    return nearby_places
+
+def load_places_index(file_path):
+    if file_path.endswith(".json"):
+        with open(file_path, "r") as file:
+            elements = json.load(file)["elements"]
+        nodes = [node for node in elements if node.get("type") == "node" and "place" in node.get("tags", {}) and "name" in node["tags"]]
+        latitudes = np.array([float(node["lat"]) for node in nodes])
+        longitudes = np.array([float(node["lon"]) for node in nodes])
+        names = np.array([node["tags"]["name"] for node in nodes], dtype=object)
+    else:
+        df = pd.read_csv(file_path, keep_default_na=False)
+        if 'Latitude' not in df.columns or 'Longitude' not in df.columns or 'Name' not in df.columns:
+            raise ValueError("CSV file must contain 'Latitude', 'Longitude', and 'Name' columns")
+        latitudes = df['Latitude'].to_numpy(dtype=np.float64)
+        longitudes = df['Longitude'].to_numpy(dtype=np.float64)
+        names = df['Name'].to_numpy(dtype=object)
+
+    tree = BallTree(np.radians(np.column_stack([latitudes, longitudes])), metric="haversine")
+
+    return {"tree": tree, "latitudes": latitudes, "longitudes": longitudes, "names": names}
+
+def get_nearby_places_batch(places_index, latitudes, longitudes):
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    k = min(CANDIDATE_NEARBY_PLACES, len(places_index["names"]))
+    if k == 0:
+        return ["" for _ in range(len(latitudes))]
+
+    great_circle_distances, indices = places_index["tree"].query(np.radians(np.column_stack([latitudes, longitudes])), k=k)
+    place_latitudes = places_index["latitudes"][indices]
+    place_longitudes = places_index["longitudes"][indices]
+    lat = np.broadcast_to(latitudes[:, None], indices.shape)
+    lon = np.broadcast_to(longitudes[:, None], indices.shape)
+
+    _, _, distances = Geod(ellps="WGS84").inv(lon.ravel(), lat.ravel(), place_longitudes.ravel(), place_latitudes.ravel())
+    distances = distances.reshape(indices.shape) / 1000
+    distances[great_circle_distances * EARTH_RADIUS_IN_KM > MAXIMUM_RADIUS_IN_KM] = np.inf
+
+    lat1, lon1, lat2, lon2 = np.radians(lat), np.radians(lon), np.radians(place_latitudes), np.radians(place_longitudes)
+    bearings = np.degrees(np.arctan2(np.sin(lon2-lon1)*np.cos(lat2), np.cos(lat1)*np.sin(lat2)-np.sin(lat1)*np.cos(lat2)*np.cos(lon2-lon1)))
+    bearings = (bearings + 360) % 360
+    directions = np.array(COMPASS_DIRECTIONS, dtype=object)[np.round(bearings / 45).astype(np.int64) % 8]
+
+    order = np.argsort(distances, axis=1, kind="stable")[:, :MAXIMUM_NEARBY_PLACES]
+    rows = np.arange(len(latitudes))[:, None]
+    names = places_index["names"][indices[rows, order]]
+    distances = distances[rows, order]
+    directions = directions[rows, order]
+
+    nearby_places = []
+    for row_names, row_distances, row_directions in zip(names, distances, directions):
+        places = [place for place in zip(row_names, row_distances, row_directions) if np.isfinite(place[1])]
+        nearby_places.append(format_nearby_places(places))
+
+    return nearby_places
+
+def get_cache_key(endpoint, lat, lon):
+    return make_cache_key(endpoint, round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION))
+
+def get_nearby_places(lat, lon, cache=None):
+    key = get_cache_key("overpass", lat, lon)
+    cached = cache.get(key) if cache else None
+    if cached is not None:
+        return cached["nearby_places"]
+
     query = f"""
+    [out:json];
     (
         node(around:{MAXIMUM_RADIUS_IN_KM * 1000},{lat},{lon})["name"]["place"];
         >;
     );
     out meta;
     """
-    result = overpy.Overpass().query(query)
+    def request():
+        with Timer("overpass", requests.exceptions.Timeout):
+            response = session.post(OVERPASS_URL, data={"data": query}, timeout=TIMEOUT)
+            response.raise_for_status()
+            return response.json()["elements"]
 
-    places = parse_places_data(result, lat, lon)
+    elements = call_with_retries(HEDGERS["overpass"], request, TIMEOUT, MAX_RETRIES, RETRYABLE_ERRORS, RATE_LIMITERS["overpass"].acquire)
 
-    nearby_places = ""
-    for i, place in enumerate(places[:MAXIMUM_NEARBY_PLACES]):
-        nearby_places += f"{place[1]:.1f} km {place[2]}: {place[0]}\n"
+    places = parse_places_data(elements, lat, lon)
+    nearby_places = format_nearby_places(places)
+
+    if cache:
+        cache.put(key, {"nearby_places": nearby_places})
 
     return nearby_places
 
-def get_address(lat, lon):
-    nominatim_url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=18&addressdetails=1"
+def get_address(lat, lon, cache=None):
+    key = get_cache_key("nominatim", lat, lon)
+    cached = cache.get(key) if cache else None
+    if cached is not None:
+        return cached["address"]
+
+    params = {"format": "json", "lat": lat, "lon": lon, "zoom": 18, "addressdetails": 1}
+
+    def request():
+        with Timer("nominatim", requests.exceptions.Timeout):
+            response = session.get(NOMINATIM_URL, params=params, timeout=TIMEOUT)
+            response.raise_for_status()
+            return json.loads(response.text)
 
-    response = requests.get(nominatim_url)
-    data = json.loads(response.text)
+    data = call_with_retries(HEDGERS["nominatim"], request, TIMEOUT, MAX_RETRIES, RETRYABLE_ERRORS, RATE_LIMITERS["nominatim"].acquire)
 
     if 'error' in data:
-        return None
+        formatted_address = None
+    else:
+        address = data['address']
 
-    address = data['address']
+        formatted_address = []
+        for key_name in address:
+            if "-" in key_name or "number" in key_name or "code" in key_name:
+                continue
+            formatted_address.append(address[key_name])
+        formatted_address = ', '.join(formatted_address)
 
-    formatted_address = []
-    for key in address:
-        if "-" in key or "number" in key or "code" in key:
-            continue
-        formatted_address.append(address[key])
+    if cache:
+        cache.put(key, {"address": formatted_address})
 
-    return ', '.join(formatted_address)
+    return formatted_address
 
-def get_prompt(lat, lon):
+def get_prompt(lat, lon, cache=None, nearby_places=None):
     coordinates = f"({lat:.5f}, {lon:.5f})"
-    address = get_address(lat, lon)
-    nearby_places = get_nearby_places(lat, lon)
+    address = get_address(lat, lon, cache)
+    if nearby_places is None:
+        nearby_places = get_nearby_places(lat, lon, cache)
     prompt = f"Coordinates: {coordinates}\n\nAddress: \"{address}\"\n\nNearby Places:\n\"\n{nearby_places}\"\n\n<TASK> (On a Scale from 0.0 to 9.9): "
     return prompt
 
-def get_prompt_executor(index, coordinates, prompts):
-    try:
-        lat, lon = coordinates[index]
-        prompts[index] = get_prompt(lat, lon)
-        print(f"Generated prompt {index + 1}")
-    except Exception as e:
-        print(f"Error while generating prompt {index + 1}: {e}")
+def write_prompts(prompts, output_file):
+    temporary_path = f"{output_file}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as file:
+        for prompt in prompts:
+            if prompt:
+                file.write(json.dumps({"text": prompt}) + "\n")
+    os.replace(temporary_path, output_file)
+
+def get_journal_file(output_file):
+    return f"{output_file}.journal.jsonl"
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+def load_journaled_prompts(journal, coordinates):
+    prompts = ["" for _ in range(len(coordinates))]
+    for index, record in journal.records.items():
+        if index < len(coordinates) and (record["latitude"], record["longitude"]) == tuple(map(float, coordinates[index])):
+            prompts[index] = record["text"]
+    return prompts
 
-def get_prompts(coordinates, output_file=None):
+def get_prompts(coordinates, output_file=None, cache_file=GEOCODING_CACHE_FILE, places_file=None, verbose=False):
     prompts = ["" for _ in range(len(coordinates))]
-    prompt_indices = list(range(len(prompts)))
+    journal = Journal(get_journal_file(output_file)) if output_file else None
+    if journal is not None:
+        prompts = load_journaled_prompts(journal, coordinates)
+        done = sum(1 for prompt in prompts if prompt)
+        if done:
+            print(f"Resuming, {done} of {len(coordinates)} prompts already generated.")
+
+    cache = DiskCache(cache_file) if cache_file else None
 
-    while prompt_indices:
-        failed_indices = []
+    latitudes, longitudes = zip(*coordinates) if coordinates else ((), ())
+    duplicates = find_duplicate_groups(latitudes, longitudes)
+    if duplicates:
+        print(f"Coordinates: {describe_duplicates(len(coordinates), count_unique(len(coordinates), duplicates))}. Each location is only geocoded once.")
 
-        for chunk in chunks(prompt_indices, MAX_WORKERS):
-            print("New Batch")
+    nearby_places = [None] * len(coordinates)
+    if places_file:
+        places_index = load_places_index(places_file)
+        nearby_places = get_nearby_places_batch(places_index, latitudes, longitudes)
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = {executor.submit(get_prompt_executor, index, coordinates, prompts): index for index in chunk}
-                for future in concurrent.futures.as_completed(futures):
-                    index = futures[future]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            def submit(index, attempt):
+                lat, lon = coordinates[index]
+                future = executor.submit(get_prompt, lat, lon, cache, nearby_places[index])
+                futures[future] = (index, attempt)
+
+            def store(index, prompt):
+                for member in duplicates.get(index, (index,)):
+                    if prompts[member]:
+                        continue
+                    prompts[member] = prompt
+                    if journal is not None:
+                        lat, lon = coordinates[member]
+                        journal.append(member, latitude=float(lat), longitude=float(lon), text=prompt)
+                    ROWS_WRITTEN.inc(stage="prompts")
+
+            futures = {}
+            for index in range(len(coordinates)):
+                group = duplicates.get(index, (index,))
+                if index != group[0] or all(prompts[member] for member in group):
+                    continue
+                answered = next((member for member in group if prompts[member]), None)
+                if answered is None:
+                    submit(index, 1)
+                else:
+                    store(answered, prompts[answered])
+
+            while futures:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    index, attempt = futures.pop(future)
                     try:
-                        future.result(timeout=TIMEOUT)
-                    except concurrent.futures.TimeoutError:
-                        print(f"Generation for prompt {index + 1} did not complete within 30 seconds, rescheduling...")
-                        failed_indices.append(index)
-            
-            time.sleep(MIN_DELAY)
-            
-            if output_file:
-                with open(output_file, "w") as file:
-                    for prompt in prompts:
-                        if prompt:
-                            file.write(json.dumps({"text": prompt}) + "\n")
-        
-        prompt_indices = failed_indices
+                        store(index, future.result())
+                        if verbose:
+                            print(f"Generated prompt {index + 1}:\n{prompts[index]}")
+                    except Exception as e:
+                        if attempt < MAX_ATTEMPTS:
+                            if verbose:
+                                print(f"Error while generating prompt {index + 1}: {e}, rescheduling...")
+                            RETRIES.inc(endpoint="prompt")
+                            submit(index, attempt + 1)
+                        else:
+                            print(f"Error while generating prompt {index + 1}: {e}, giving up after {MAX_ATTEMPTS} attempts")
+    finally:
+        if journal is not None:
+            journal.close()
+        for hedger in HEDGERS.values():
+            hedger.close()
+
+    if output_file:
+        write_prompts(prompts, output_file)
+
+    if cache:
+        stats = cache.stats()
+        print(f"Geocoding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+        cache.close()
 
     return prompts
 
+def generate_shard(coordinates, part_file, cache_file=GEOCODING_CACHE_FILE, places_file=None,
+                   nominatim_requests_per_minute=NOMINATIM_REQUESTS_PER_MINUTE, overpass_requests_per_minute=OVERPASS_REQUESTS_PER_MINUTE, verbose=False,
+                   metrics_interval=REPORT_INTERVAL, metrics_snapshots=False, hedge_quantile=HEDGE_QUANTILE,
+                   max_hedge_fraction=MAX_HEDGE_FRACTION):
+    RATE_LIMITERS["nominatim"] = RateLimiter(requests_per_minute=nominatim_requests_per_minute)
+    RATE_LIMITERS["overpass"] = RateLimiter(requests_per_minute=overpass_requests_per_minute)
+    HEDGERS["nominatim"] = Hedger("nominatim", hedge_quantile, max_hedge_fraction)
+    HEDGERS["overpass"] = Hedger("overpass", hedge_quantile, max_hedge_fraction)
+    with MetricsReporter(metrics_interval, f"{part_file}.metrics.jsonl" if metrics_snapshots else None):
+        prompts = get_prompts(coordinates, part_file, cache_file, places_file, verbose)
+    return sum(1 for prompt in prompts if prompt)
+
 def main():
     parser = argparse.ArgumentParser(description="Generate GeoLLM prompts based on coordinates.")
     parser.add_argument("coordinates_csv", type=str, help="Path to the CSV file containing coordinates.")
     parser.add_argument("--output_jsonl", type=str, help="Path to the output JSONL file. Defaults to the same name as the CSV file, located in the prompts/ folder.")
+    parser.add_argument("--cache", type=str, default=GEOCODING_CACHE_FILE, help="Path to the reverse-geocoding and nearby-places cache.")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read from or write to the geocoding cache.")
+    parser.add_argument("--places_file", type=str, help="Local extract of OSM place=* nodes (CSV with 'Latitude', 'Longitude' and 'Name' columns, or Overpass JSON). Nearby places are computed offline instead of querying Overpass.")
+    parser.add_argument("--nominatim_requests_per_minute", type=int, default=NOMINATIM_REQUESTS_PER_MINUTE, help="Rate limit for Nominatim requests. The public Nominatim allows 60 per minute; only raise it for a self-hosted instance.")
+    parser.add_argument("--overpass_requests_per_minute", type=int, default=OVERPASS_REQUESTS_PER_MINUTE, help="Rate limit for Overpass requests.")
+    parser.add_argument("--hedge_quantile", type=float, default=HEDGE_QUANTILE, help="Send a duplicate of Nominatim and Overpass requests that are still running after this quantile of their recent latencies.")
+    parser.add_argument("--max_hedge_fraction", type=float, default=MAX_HEDGE_FRACTION, help="Maximum fraction of requests that are hedged (0 to disable hedging).")
+    parser.add_argument("--num_shards", type=int, help="Split the coordinates into this many contiguous shards, each written to its own part file next to the output file.")
+    parser.add_argument("--shards", type=int, nargs="+", help="Only run these shard indices (e.g. one shard per node). Defaults to every shard that is not complete yet.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of shards to run in parallel processes. The rate limits are split between them.")
+    parser.add_argument("--force", action="store_true", help="Rerun the selected shards even if they are already complete.")
+    parser.add_argument("--verbose", action="store_true", help="Print every generated prompt and every error that is retried.")
+    parser.add_argument("--metrics_interval", type=float, default=REPORT_INTERVAL, help="Seconds between progress lines with request rate, errors, retries, timeouts and latency (0 to disable).")
+    parser.add_argument("--metrics_file", type=str, help="Append a JSON snapshot of every counter and histogram to this file at each progress line. Sharded runs write one file per shard next to its part file instead.")
+    parser.add_argument("--metrics_port", type=int, help="Serve the metrics in the Prometheus text format on this port (at /metrics). Not available for sharded runs.")
 
     args = parser.parse_args()
 
@@ -146,7 +358,44 @@ def main():
     else:
         raise ValueError("CSV file must contain 'Latitude' and 'Longitude' columns")
     
-    get_prompts(coordinates, output_jsonl)
+    cache_file = None if args.no_cache else args.cache
+
+    if args.num_shards:
+        processes = max(1, min(args.processes, len(args.shards) if args.shards else args.num_shards))
+        manifest = run_shards(
+            generate_shard,
+            coordinates,
+            output_jsonl,
+            args.num_shards,
+            shards=args.shards,
+            processes=processes,
+            force=args.force,
+            source=coordinates_csv,
+            cache_file=cache_file,
+            places_file=args.places_file,
+            nominatim_requests_per_minute=args.nominatim_requests_per_minute / processes,
+            overpass_requests_per_minute=args.overpass_requests_per_minute / processes,
+            verbose=args.verbose,
+            metrics_interval=args.metrics_interval,
+            metrics_snapshots=bool(args.metrics_file),
+            hedge_quantile=args.hedge_quantile,
+            max_hedge_fraction=args.max_hedge_fraction
+        )
+
+        remaining = [entry["shard"] for entry in manifest["shards"] if not entry["complete"]]
+        if remaining:
+            print(f"{len(remaining)} of {args.num_shards} shards are not complete yet: {' '.join(map(str, remaining))}")
+        else:
+            print(f"Merged {merge_shards(output_jsonl)} prompts into {output_jsonl}")
+        return
+
+    RATE_LIMITERS["nominatim"] = RateLimiter(requests_per_minute=args.nominatim_requests_per_minute)
+    RATE_LIMITERS["overpass"] = RateLimiter(requests_per_minute=args.overpass_requests_per_minute)
+    HEDGERS["nominatim"] = Hedger("nominatim", args.hedge_quantile, args.max_hedge_fraction)
+    HEDGERS["overpass"] = Hedger("overpass", args.hedge_quantile, args.max_hedge_fraction)
+
+    with MetricsReporter(args.metrics_interval, args.metrics_file, args.metrics_port):
+        get_prompts(coordinates, output_jsonl, cache_file, args.places_file, args.verbose)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import concurrent.futures
+import random
+import threading
+import time
+from async_predictions import RETRYABLE_STATUSES
+from instrumentation import HEDGES, RETRIES, TIMEOUTS
+
+HEDGE_QUANTILE = 0.95
+MAX_HEDGE_FRACTION = 0.05
+MIN_SAMPLES = 20
+WINDOW = 1000
+MAX_WORKERS = 64
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+class LatencyTracker:
+    def __init__(self, window=WINDOW, min_samples=MIN_SAMPLES):
+        self.latencies = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def quantile(self, q):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+class Hedger:
+    """Sends a duplicate of a request that is slower than the endpoint's recent `quantile` latency, for at most
+    `max_fraction` of the requests, and returns whichever response comes first."""
+
+    def __init__(self, endpoint, quantile=HEDGE_QUANTILE, max_fraction=MAX_HEDGE_FRACTION, max_workers=MAX_WORKERS):
+        self.endpoint = endpoint
+        self.quantile = quantile
+        self.max_fraction = max_fraction
+        self.max_workers = max_workers
+        self.tracker = LatencyTracker()
+        self.requests = 0
+        self.hedges = 0
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_delay(self):
+        with self.lock:
+            self.requests += 1
+        return self.tracker.quantile(self.quantile) if self.max_fraction > 0 else None
+
+    def reserve_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > self.max_fraction * self.requests:
+                return False
+            self.hedges += 1
+        HEDGES.inc(endpoint=self.endpoint, result="sent")
+        return True
+
+    def timed(self, function, acquire=None):
+        if acquire:
+            acquire()
+        start_time = time.perf_counter()
+        result = function()
+        self.tracker.observe(time.perf_counter() - start_time)
+        return result
+
+    async def timed_async(self, function, acquire=None):
+        if acquire:
+            await acquire()
+        start_time = time.perf_counter()
+        result = await function()
+        self.tracker.observe(time.perf_counter() - start_time)
+        return result
+
+    def get_wait(self, start_time, deadline, delay, hedged):
+        now = time.monotonic()
+        waits = [] if deadline is None else [max(deadline - now, 0)]
+        if not hedged and delay is not None:
+            waits.append(max(start_time + delay - now, 0))
+        return min(waits) if waits else None
+
+    def on_timeout(self):
+        TIMEOUTS.inc(endpoint=self.endpoint)
+        return TimeoutError(f"{self.endpoint} request timed out")
+
+    def call(self, function, timeout=None, acquire=None):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"hedge-{self.endpoint}")
+
+        if acquire:
+            acquire()
+        start_time = time.monotonic()
+        deadline = None if timeout is None else start_time + timeout
+        delay = self.get_delay()
+        futures = {self.executor.submit(self.timed, function): False}
+        hedged, error = False, None
+
+        while futures:
+            done, _ = concurrent.futures.wait(futures, timeout=self.get_wait(start_time, deadline, delay, hedged), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                is_hedge = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                for other in futures:
+                    other.cancel()
+                if is_hedge:
+                    HEDGES.inc(endpoint=self.endpoint, result="won")
+                return result
+
+            if done:
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                for other in futures:
+                    other.cancel()
+                raise self.on_timeout()
+            if not hedged:
+                hedged = True
+                if self.reserve_hedge():
+                    futures[self.executor.submit(self.timed, function, acquire)] = True
+
+        raise error
+
+    def close(self):
+        # Abandoned attempts are not waited for. They end at their own request timeout.
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def call_async(self, function, timeout=None, acquire=None):
+        # `function` and `acquire` return a new coroutine on every call.
+        if acquire:
+            await acquire()
+        start_time = time.monotonic()
+        deadline = None if timeout is None else start_time + timeout
+        delay = self.get_delay()
+        tasks = {asyncio.ensure_future(self.timed_async(function)): False}
+        hedged, error = False, None
+
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=self.get_wait(start_time, deadline, delay, hedged), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    is_hedge = tasks.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if is_hedge:
+                        HEDGES.inc(endpoint=self.endpoint, result="won")
+                    return result
+
+                if done:
+                    continue
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise self.on_timeout()
+                if not hedged:
+                    hedged = True
+                    if self.reserve_hedge():
+                        tasks[asyncio.ensure_future(self.timed_async(function, acquire))] = True
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        raise error
+
+def backoff_delay(attempt):
+    delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+    return delay + random.uniform(0, delay / 2)
+
+def has_retryable_status(error):
+    # HTTP errors are only retried for timeouts, conflicts, rate limits and server errors.
+    response = getattr(error, "response", None)
+    return response is None or getattr(response, "status_code", None) in RETRYABLE_STATUSES
+
+def call_with_retries(hedger, function, timeout=None, max_retries=0, retryable_errors=(TimeoutError,), acquire=None):
+    attempt = 0
+    while True:
+        try:
+            return hedger.call(function, timeout, acquire)
+        except retryable_errors as e:
+            if attempt >= max_retries or not has_retryable_status(e):
+                raise
+            RETRIES.inc(endpoint=hedger.endpoint)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
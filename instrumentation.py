@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+REPORT_INTERVAL = 10.0
+
+def get_label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = get_label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels):
+        wanted = set(get_label_key(labels))
+        with self.lock:
+            return sum(value for key, value in self.values.items() if wanted <= set(key))
+
+    def to_prometheus(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            lines += [f"{self.name}{format_labels(key)} {value}" for key, value in sorted(self.values.items())]
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {",".join(f"{name}={value}" for name, value in key): value for key, value in sorted(self.values.items())}
+
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = get_label_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def merged_counts(self, **labels):
+        wanted = set(get_label_key(labels))
+        merged = [0] * (len(self.buckets) + 1)
+        with self.lock:
+            for key, (counts, _) in self.values.items():
+                if wanted <= set(key):
+                    merged = [a + b for a, b in zip(merged, counts)]
+        return merged
+
+    def quantile(self, q, **labels):
+        # Linear interpolation within the bucket, like Prometheus' histogram_quantile.
+        counts = self.merged_counts(**labels)
+        count = sum(counts)
+        if not count:
+            return None
+
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def to_prometheus(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(key, [('le', bucket)])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        snapshot = {}
+        with self.lock:
+            keys = sorted(self.values)
+        for key in keys:
+            labels = dict(key)
+            counts, total = self.values[key]
+            snapshot[",".join(f"{name}={value}" for name, value in key)] = {
+                "count": sum(counts),
+                "sum": total,
+                "p50": self.quantile(0.5, **labels),
+                "p99": self.quantile(0.99, **labels)
+            }
+        return snapshot
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, metric_type, name, description, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_type(name, description, **kwargs)
+            return self.metrics[name]
+
+    def to_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.to_prometheus()) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {"time": time.time(), **{metric.name: metric.snapshot() for metric in metrics}}
+
+REGISTRY = Registry()
+
+def counter(name, description):
+    return REGISTRY.get(Counter, name, description)
+
+def histogram(name, description, buckets=LATENCY_BUCKETS):
+    return REGISTRY.get(Histogram, name, description, buckets=buckets)
+
+REQUESTS = counter("geollm_requests_total", "Requests to Nominatim, Overpass and the LLM providers by endpoint and outcome.")
+REQUEST_LATENCY = histogram("geollm_request_latency_seconds", "Latency of every request attempt by endpoint.")
+RETRIES = counter("geollm_retries_total", "Requests that were retried by endpoint.")
+TIMEOUTS = counter("geollm_timeouts_total", "Requests that timed out by endpoint.")
+PARSE_FAILURES = counter("geollm_parse_failures_total", "Completions without a rating by task.")
+CACHE_LOOKUPS = counter("geollm_cache_lookups_total", "Cache lookups by cache file and result (hit or miss).")
+HEDGES = counter("geollm_hedges_total", "Hedged duplicate requests by endpoint and result (sent, or won when the hedge answered first).")
+ROWS_WRITTEN = counter("geollm_rows_written_total", "Prompts and predictions written to the journals by stage.")
+
+class Timer:
+    """Records the latency and outcome of one request attempt: `with Timer("nominatim"): ...`."""
+
+    def __init__(self, endpoint, timeout_errors=(TimeoutError,)):
+        self.endpoint = endpoint
+        self.timeout_errors = timeout_errors
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        REQUEST_LATENCY.observe(time.perf_counter() - self.start_time, endpoint=self.endpoint)
+        if exc_type is None:
+            outcome = "ok"
+        elif issubclass(exc_type, asyncio.CancelledError):
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+        REQUESTS.inc(endpoint=self.endpoint, outcome=outcome)
+        if exc_type is not None and issubclass(exc_type, self.timeout_errors):
+            TIMEOUTS.inc(endpoint=self.endpoint)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def get_progress(previous, current, elapsed):
+    requests = current["requests"] - previous["requests"]
+    errors = current["errors"] - previous["errors"]
+    hedges = f", {current['hedges']} hedges ({current['hedges_won']} won)" if current["hedges"] else ""
+    p50, p99 = REQUEST_LATENCY.quantile(0.5), REQUEST_LATENCY.quantile(0.99)
+    latency = f", p50 {p50 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms" if p50 is not None else ""
+    return (f"{current['requests']} requests ({requests / elapsed:.1f}/s), {current['errors']} errors "
+            f"({errors / requests if requests else 0.0:.1%} recently), {current['retries']} retries, {current['timeouts']} timeouts{hedges}, "
+            f"{current['parse_failures']} parse failures, {current['rows']} rows written{latency}")
+
+def get_totals():
+    return {
+        "requests": REQUESTS.total(),
+        "errors": REQUESTS.total(outcome="error"),
+        "retries": RETRIES.total(),
+        "timeouts": TIMEOUTS.total(),
+        "hedges": HEDGES.total(result="sent"),
+        "hedges_won": HEDGES.total(result="won"),
+        "parse_failures": PARSE_FAILURES.total(),
+        "rows": ROWS_WRITTEN.total()
+    }
+
+class MetricsReporter:
+    """Prints a progress line every `interval` seconds, and optionally snapshots the metrics to a file or serves them."""
+
+    def __init__(self, interval=REPORT_INTERVAL, snapshot_file=None, port=None):
+        self.interval = interval
+        self.snapshot_file = snapshot_file
+        self.port = port
+        self.stopped = threading.Event()
+        self.server = None
+        self.thread = None
+
+    def report(self):
+        now, totals = time.time(), get_totals()
+        print(f"Metrics: {get_progress(self.previous, totals, max(now - self.previous_time, 1e-9))}")
+        self.previous, self.previous_time = totals, now
+
+        if self.snapshot_file:
+            with open(self.snapshot_file, "a") as file:
+                file.write(json.dumps(REGISTRY.snapshot()) + "\n")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self.previous, self.previous_time = get_totals(), time.time()
+        if self.port:
+            self.server = ThreadingHTTPServer(("", self.port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f"Serving metrics on http://localhost:{self.port}/metrics")
+        if self.interval:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.report()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
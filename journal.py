@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+
+FSYNC_EVERY = 100
+
+def load_journal(file_path):
+    records = {}
+    if not os.path.exists(file_path):
+        return records
+
+    with open(file_path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record['index']] = record
+
+    return records
+
+def truncate_partial_line(file_path):
+    with open(file_path, 'rb+') as file:
+        data = file.read()
+        if data and not data.endswith(b"\n"):
+            file.truncate(data.rfind(b"\n") + 1)
+
+class Journal:
+    def __init__(self, file_path, fsync_every=FSYNC_EVERY):
+        self.file_path = file_path
+        self.fsync_every = fsync_every
+        self.records = load_journal(file_path)
+        if os.path.exists(file_path):
+            truncate_partial_line(file_path)
+        self.file = open(file_path, 'a')
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, index):
+        return index in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, index, **fields):
+        record = {"index": index, **fields}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.records[index] = record
+            self.pending += 1
+            if self.pending >= self.fsync_every:
+                self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from utils import split_prompt
+
+ANSWER_PREFIX = "My answer is"
+BATCH_SIZE = 16
+DIGITS = "0123456789"
+
+LOCAL_MODELS = {}
+
+def common_prefix_length(sequences):
+    length = min(len(sequence) for sequence in sequences)
+    for position in range(length):
+        token = sequences[0][position]
+        if any(sequence[position] != token for sequence in sequences):
+            return position
+    return length
+
+def expand_cache(past_key_values, batch_size):
+    return tuple(tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer) for layer in past_key_values)
+
+def crop_cache(past_key_values, length):
+    return tuple(tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values)
+
+def to_legacy_cache(past_key_values):
+    return past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
+
+class LocalModel:
+    """Open-weight causal LM on CPU that answers GeoLLM prompts in batches.
+
+    Prompts are encoded once, the longest token prefix they share (the instructions in PREFIX) is run through the
+    model a single time and its KV cache is reused by every batch. The answer is forced to "My answer is X.X." and the
+    digit logprobs are read straight from the logits, so generation is only two steps per batch.
+    """
+
+    def __init__(self, model_name, batch_size=BATCH_SIZE, threads=None):
+        if threads:
+            torch.set_num_threads(threads)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        self.model.eval()
+        self.batch_size = batch_size
+
+        self.digit_tokens = self.get_digit_tokens()
+        self.period_token = self.get_period_token()
+        self.prefix_ids = []
+        self.prefix_cache = None
+
+    def get_digit_tokens(self):
+        digit_tokens = {digit: [] for digit in DIGITS}
+        for token_id in range(len(self.tokenizer)):
+            text = self.tokenizer.decode([token_id]).strip()
+            if text in digit_tokens:
+                digit_tokens[text].append(token_id)
+        return [np.array(digit_tokens[digit]) for digit in DIGITS]
+
+    def get_period_token(self):
+        token_id = self.tokenizer.convert_tokens_to_ids(".")
+        if token_id is None or token_id == self.tokenizer.unk_token_id:
+            token_id = self.tokenizer.encode(".", add_special_tokens=False)[-1]
+        return token_id
+
+    def format_prompt(self, prompt, system=None):
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+
+        if getattr(self.tokenizer, "chat_template", None):
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            return self.tokenizer.encode(text + ANSWER_PREFIX, add_special_tokens=False)
+
+        text = "\n\n".join(message["content"] for message in messages)
+        return self.tokenizer.encode(f"{text}\n\n{ANSWER_PREFIX}")
+
+    def get_prefix_cache(self, sequences):
+        length = min(common_prefix_length([self.prefix_ids] + sequences) if self.prefix_ids else common_prefix_length(sequences),
+                     min(len(sequence) for sequence in sequences) - 1)
+
+        if length < len(self.prefix_ids):
+            self.prefix_ids = self.prefix_ids[:length]
+            self.prefix_cache = crop_cache(self.prefix_cache, length) if length else None
+        elif not self.prefix_ids and length > 0:
+            with torch.no_grad():
+                output = self.model(torch.tensor([sequences[0][:length]]), use_cache=True)
+            self.prefix_ids = sequences[0][:length]
+            self.prefix_cache = to_legacy_cache(output.past_key_values)
+
+        return len(self.prefix_ids), self.prefix_cache
+
+    def forward(self, input_ids, attention_mask, position_ids, past_key_values):
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        return output.logits, output.past_key_values
+
+    def digit_logprobs(self, logits):
+        logprobs = torch.log_softmax(logits.float(), dim=-1).numpy()
+        return np.stack([np.logaddexp.reduce(logprobs[:, tokens], axis=1) for tokens in self.digit_tokens], axis=1)
+
+    def best_digit_tokens(self, logits, digits):
+        logits = logits.numpy()
+        return [int(self.digit_tokens[digit][np.argmax(logits[row, self.digit_tokens[digit]])]) for row, digit in enumerate(digits)]
+
+    def complete_batch(self, prompts, systems=None):
+        systems = systems or [None] * len(prompts)
+        sequences = [self.format_prompt(prompt, system) for prompt, system in zip(prompts, systems)]
+        prefix_length, prefix_cache = self.get_prefix_cache(sequences)
+        suffixes = [sequence[prefix_length:] for sequence in sequences]
+        lengths = torch.tensor([len(suffix) for suffix in suffixes])
+
+        batch_size, width = len(suffixes), int(lengths.max())
+        pad_token = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        input_ids = torch.full((batch_size, width), pad_token, dtype=torch.long)
+        suffix_mask = torch.zeros((batch_size, width), dtype=torch.long)
+        for row, suffix in enumerate(suffixes):
+            input_ids[row, :len(suffix)] = torch.tensor(suffix)
+            suffix_mask[row, :len(suffix)] = 1
+
+        # Right padding with explicit positions, so every row continues the shared prefix at the same offset.
+        attention_mask = torch.cat([torch.ones((batch_size, prefix_length), dtype=torch.long), suffix_mask], dim=1)
+        position_ids = prefix_length + torch.arange(width).expand(batch_size, width)
+        past_key_values = expand_cache(prefix_cache, batch_size) if prefix_cache else None
+
+        logits, past_key_values = self.forward(input_ids, attention_mask, position_ids, past_key_values)
+        last_logits = logits[torch.arange(batch_size), lengths - 1]
+        integer_logprobs = self.digit_logprobs(last_logits)
+        integers = integer_logprobs.argmax(axis=1)
+
+        answer_ids = torch.tensor([[token, self.period_token] for token in self.best_digit_tokens(last_logits, integers)])
+        attention_mask = torch.cat([attention_mask, torch.ones((batch_size, 2), dtype=torch.long)], dim=1)
+        position_ids = prefix_length + lengths[:, None] + torch.arange(2)[None, :]
+
+        logits, _ = self.forward(answer_ids, attention_mask, position_ids, past_key_values)
+        decimal_logprobs = self.digit_logprobs(logits[:, -1])
+        decimals = decimal_logprobs.argmax(axis=1)
+
+        return [
+            get_response(integer, decimal, integer_logprobs[row], decimal_logprobs[row], len(sequences[row]), prefix_length)
+            for row, (integer, decimal) in enumerate(zip(integers, decimals))
+        ]
+
+    def complete(self, prompts, systems=None):
+        systems = systems or [None] * len(prompts)
+        responses = []
+        for start in range(0, len(prompts), self.batch_size):
+            end = start + self.batch_size
+            responses.extend(self.complete_batch(prompts[start:end], systems[start:end]))
+        return responses
+
+def digit_entry(digit, logprobs):
+    return {
+        "token": DIGITS[digit],
+        "logprob": float(logprobs[digit]),
+        "top_logprobs": [{"token": DIGITS[index], "logprob": float(logprobs[index])} for index in np.argsort(-logprobs)]
+    }
+
+def get_response(integer, decimal, integer_logprobs, decimal_logprobs, prompt_tokens, cached_tokens):
+    return {
+        "completion": f"{ANSWER_PREFIX} {integer}.{decimal}.",
+        "logprobs": [
+            {"token": f"{ANSWER_PREFIX} ", "logprob": 0.0, "top_logprobs": []},
+            digit_entry(integer, integer_logprobs),
+            {"token": ".", "logprob": 0.0, "top_logprobs": []},
+            digit_entry(decimal, decimal_logprobs),
+            {"token": ".", "logprob": 0.0, "top_logprobs": []}
+        ],
+        "usage": {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "completion_tokens": 2}
+    }
+
+def get_local_model(model_name, batch_size=BATCH_SIZE, threads=None):
+    if model_name not in LOCAL_MODELS:
+        LOCAL_MODELS[model_name] = LocalModel(model_name, batch_size, threads)
+    local_model = LOCAL_MODELS[model_name]
+    local_model.batch_size = batch_size
+    return local_model
+
+def get_local_completions(model_name, prompts, batch_size=BATCH_SIZE, threads=None, prefix_caching=False):
+    systems = None
+    if prefix_caching:
+        systems, prompts = zip(*[split_prompt(prompt) for prompt in prompts])
+        systems, prompts = list(systems), list(prompts)
+    return get_local_model(model_name, batch_size, threads).complete(prompts, systems)
+
+def get_local_completion(model_name, prompt, prefix_caching=False):
+    return get_local_completions(model_name, [prompt], prefix_caching=prefix_caching)[0]
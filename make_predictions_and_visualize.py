@@ -1,22 +1,61 @@
 import argparse
 from utils import *
+from async_predictions import post_json, run_prompts_async
+from journal import Journal
+from cache import DiskCache, make_cache_key
+from dedup import count_unique, describe_duplicates, find_duplicate_groups
+from instrumentation import PARSE_FAILURES, REPORT_INTERVAL, ROWS_WRITTEN, MetricsReporter, Timer
+from hedging import HEDGE_QUANTILE, MAX_HEDGE_FRACTION, Hedger, call_with_retries
+from map_rendering import RENDERERS, get_rank_colormap
+from scoring import normalize_logprobs, score_completion
 import os
+import asyncio
 import json
 import numpy as np
 import pandas as pd
-import math
 import re
 import time
-import signal
+import functools
+import inspect
 import requests
 import openai
 import google.generativeai as genai
 import folium
+import aiohttp
 
 MIN_DELAY = 1.25
-
-def handler(signum, frame):
-    raise TimeoutError("Timeout occurred!")
+TIMEOUT = 20
+MAX_TOKENS = 10
+CACHE_FILE = "cache/responses.sqlite"
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+TOGETHER_API_BASE = "https://api.together.xyz/v1"
+API_BASES = {"openai": OPENAI_API_BASE, "together": TOGETHER_API_BASE}
+
+USAGE_FIELDS = ["prompt_tokens", "cached_tokens", "completion_tokens"]
+
+# System instructions, usage metadata and request options arrived after google-generativeai 0.3. Older versions get
+# the whole prompt as the user message and no request timeout.
+GENAI_SYSTEM_INSTRUCTION = "system_instruction" in inspect.signature(genai.GenerativeModel).parameters
+GENAI_REQUEST_OPTIONS = "request_options" in inspect.signature(genai.GenerativeModel.generate_content).parameters
+
+RETRYABLE_ERRORS = (
+    TimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.HTTPError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError
+)
+
+PROVIDER_RATE_LIMITS = {
+    "openai": (3500, 90000),
+    "google": (60, None),
+    "together": (600, None)
+}
 
 def write_to_csv(latitudes, longitudes, predictions, file_path):
     df = pd.DataFrame({
@@ -26,190 +65,450 @@ def write_to_csv(latitudes, longitudes, predictions, file_path):
     })
     df.to_csv(file_path, index=False)
 
-def get_rating(completion):
-    match = re.search(r"(\d+\.\d+)", completion)
-    if not match:
+GENERATION_PARAMS = {
+    "openai": {"max_tokens": MAX_TOKENS, "temperature": 0.0, "logprobs": True, "top_logprobs": 5},
+    "google": {"candidate_count": 1, "max_output_tokens": MAX_TOKENS, "temperature": 0},
+    "together": {"max_tokens": MAX_TOKENS, "temperature": 0, "logprobs": 5},
+    "local": {"max_tokens": MAX_TOKENS, "temperature": 0.0, "logprobs": True, "top_logprobs": 10}
+}
+
+def get_messages(prompt, prefix_caching=False):
+    if not prefix_caching:
+        return [{"role": "user", "content": prompt}]
+
+    system, prompt = split_prompt(prompt)
+    return [{"role": "system", "content": system}, {"role": "user", "content": prompt}] if system else [{"role": "user", "content": prompt}]
+
+def get_chat_request(model_api, model, prompt, prefix_caching=False):
+    return {
+        "model": model,
+        **GENERATION_PARAMS[model_api],
+        "messages": get_messages(prompt, prefix_caching)
+    }
+
+def get_usage(usage):
+    if not usage:
         return None
-    rating = float(match.group(0))
-    return rating
+    details = usage.get('prompt_tokens_details') or {}
+    return {
+        "prompt_tokens": usage.get('prompt_tokens') or 0,
+        "cached_tokens": details.get('cached_tokens') or 0,
+        "completion_tokens": usage.get('completion_tokens') or 0
+    }
 
-def get_openai_prediction(api_key, model, prompt):
-    openai.api_key = api_key
-    response = openai.ChatCompletion.create(
-        model=model,
-        max_tokens=10,
-        temperature=0.0,
-        logprobs=True,
-        top_logprobs=5,
-        messages=[
-            {"role": "user", "content": prompt}
-        ]
-    )
-
-    completion = response.choices[0].message['content']
-    most_probable = get_rating(completion)
+def parse_chat_response(response):
+    choice = response['choices'][0]
+    logprobs = normalize_logprobs(choice.get('logprobs'))
 
-    if most_probable is None:
-        return None, None
+    return {
+        "completion": choice['message']['content'],
+        "logprobs": json.loads(json.dumps(logprobs)) if logprobs else None,
+        "usage": json.loads(json.dumps(get_usage(response.get('usage'))))
+    }
+
+def get_openai_completion(api_key, model, prompt, api_base=None, prefix_caching=False, timeout=None):
+    openai.api_key = api_key
+    openai.api_base = api_base or OPENAI_API_BASE
+    response = openai.ChatCompletion.create(**get_chat_request("openai", model, prompt, prefix_caching), request_timeout=timeout)
+    return parse_chat_response(response)
 
-    top_logprobs = response.choices[0].logprobs['content'][4]['top_logprobs']
-    valid_items = [item for item in top_logprobs if item["token"].isdigit()]
-    total_probability = sum(math.exp(item["logprob"]) for item in valid_items)
-    expected_value = sum(int(item["token"]) * (math.exp(item["logprob"]) / total_probability) for item in valid_items)
+async def get_openai_completion_async(session, api_key, model, prompt, api_base=None, prefix_caching=False):
+    url = f"{api_base or OPENAI_API_BASE}/chat/completions"
+    response = await post_json(session, url, get_chat_request("openai", model, prompt, prefix_caching), api_key)
+    return parse_chat_response(response)
 
-    return completion, most_probable, expected_value
+def get_google_completion(api_key, model, prompt, prefix_caching=False, timeout=None):
+    system = None
+    if prefix_caching and GENAI_SYSTEM_INSTRUCTION:
+        system, prompt = split_prompt(prompt)
 
-def get_google_prediction(api_key, model, prompt):
     genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model)
-    generation_config = genai.types.GenerationConfig(
-        candidate_count=1,
-        max_output_tokens=10,
-        temperature=0
-    )
-    response = model.generate_content(prompt, generation_config=generation_config)
-    completion = response.text
-    most_probable = get_rating(completion)
-
-    return completion, most_probable, None
-
-def get_together_prediction(api_key, model, prompt):
-    url = "https://api.together.xyz/v1/chat/completions"
-
-    payload = {
-        "model": model,
-        "max_tokens": 10,
-        "temperature": 0,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ]
+    model = genai.GenerativeModel(model, system_instruction=system) if system else genai.GenerativeModel(model)
+    generation_config = genai.types.GenerationConfig(**GENERATION_PARAMS["google"])
+    request_options = {"request_options": {"timeout": timeout}} if timeout and GENAI_REQUEST_OPTIONS else {}
+    response = model.generate_content(prompt, generation_config=generation_config, **request_options)
+
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "completion": response.text,
+        "logprobs": None,
+        "usage": {
+            "prompt_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+            "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+            "completion_tokens": getattr(usage, "candidates_token_count", 0) or 0
+        } if usage is not None else None
     }
+
+def get_together_completion(api_key, model, prompt, api_base=None, prefix_caching=False, timeout=None):
+    url = f"{api_base or TOGETHER_API_BASE}/chat/completions"
+
     headers = {
         "accept": "application/json",
         "content-type": "application/json",
         "Authorization": f"Bearer {api_key}"
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+    response = requests.post(url, json=get_chat_request("together", model, prompt, prefix_caching), headers=headers, timeout=timeout)
+    response.raise_for_status()
     response = json.loads(response.text)
 
-    completion = response['choices'][0]['message']['content']
-    most_probable = get_rating(completion)
+    return parse_chat_response(response)
+
+async def get_together_completion_async(session, api_key, model, prompt, api_base=None, prefix_caching=False):
+    url = f"{api_base or TOGETHER_API_BASE}/chat/completions"
+    response = await post_json(session, url, get_chat_request("together", model, prompt, prefix_caching), api_key)
+    return parse_chat_response(response)
 
-    return completion, most_probable, None
+def get_cache_key(model_api, model, prompt, prefix_caching=False, api_base=None):
+    # The same model name can be served by different endpoints (e.g. a local OpenAI-compatible server), so the resolved
+    # base URL is part of the key. Google and local do not take a base URL.
+    endpoint = (api_base or API_BASES[model_api]) if model_api in API_BASES else None
+    if prefix_caching:
+        return make_cache_key(model_api, endpoint, model, get_messages(prompt, prefix_caching), GENERATION_PARAMS[model_api])
+    return make_cache_key(model_api, endpoint, model, prompt, GENERATION_PARAMS[model_api])
 
-def plot_on_map(latitudes, longitudes, predicted, file_path):
-    coordinates = list(zip(latitudes, longitudes))
+def estimate_tokens(prompt):
+    return len(prompt) // 4 + MAX_TOKENS
+
+def plot_on_map(latitudes, longitudes, predicted, file_path, renderer="canvas"):
     data = normalized_fractional_ranking(predicted)
 
     m = folium.Map(location=[20, 10], zoom_start=3.25, tiles='CartoDB positron')
 
-    colormap = folium.LinearColormap(colors=['red', 'yellow', 'green'], vmin=0.0, vmax=1.0)
-    colors = [colormap(val) for val in data]
-
-    for coord, color in zip(coordinates, colors):
-        folium.CircleMarker(
-            location=coord,
-            radius=7,
-            color='none',
-            fill=True,
-            fill_color=color,
-            fill_opacity=0.75
-        ).add_to(m)
+    colormap = get_rank_colormap()
+    RENDERERS[renderer](m, latitudes, longitudes, data, colormap)
 
     m.add_child(colormap)
 
     m.save(file_path)
 
-def run_task_for_data(model_api, model, task, prompt_file_path, api_key):
-    signal.signal(signal.SIGALRM, handler)
-
-    prompts = load_geollm_prompts(prompt_file_path, task)
-
-    directory = "results"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    model_name = re.sub(r'[^a-zA-Z0-9_]', '_', model)
-    task_name = re.sub(r'[^a-zA-Z0-9_]', '_', task)
-    prompts_name = re.sub(r'[^a-zA-Z0-9_]', '_', prompt_file_path.split("/")[-1].split(".")[0])
-    base_file_path = f"{directory}/{model_name}_{task_name}_{prompts_name}"
-
-    i = 0
-    latitudes = []
-    longitudes = []
-    predicted = []
-    predicted_ev = []
-
-    for prompt in prompts:
-        try:
-            i += 1
-
-            lat, lon = get_coordinates(prompt)
-
-            start_time = time.time()
-            
-            signal.alarm(20)
-
+def get_completion(model_api, api_key, model, prompt, api_base=None, prefix_caching=False, timeout=None):
+    if model_api == "openai":
+        return get_openai_completion(api_key, model, prompt, api_base, prefix_caching, timeout)
+    elif model_api == "google":
+        return get_google_completion(api_key, model, prompt, prefix_caching, timeout)
+    elif model_api == "local":
+        from local_backend import get_local_completion
+        return get_local_completion(model, prompt, prefix_caching)
+    else:
+        return get_together_completion(api_key, model, prompt, api_base, prefix_caching, timeout)
+
+def get_timed_completion(model_api, api_key, model, prompt, api_base=None, prefix_caching=False, timeout=None):
+    with Timer(model_api):
+        return get_completion(model_api, api_key, model, prompt, api_base, prefix_caching, timeout)
+
+async def get_completions_async(model_api, api_key, model, prompts, concurrency, requests_per_minute, tokens_per_minute,
+                                timeout, max_retries, api_base=None, on_result=None, prefix_caching=False, hedger=None):
+    default_requests_per_minute, default_tokens_per_minute = PROVIDER_RATE_LIMITS.get(model_api, (None, None))
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def predict(prompt):
             if model_api == "openai":
-                completion, most_probable, expected_value = get_openai_prediction(api_key, model, prompt)
+                return await get_openai_completion_async(session, api_key, model, prompt, api_base, prefix_caching)
             elif model_api == "google":
-                completion, most_probable, expected_value = get_google_prediction(api_key, model, prompt)
+                return await asyncio.to_thread(get_google_completion, api_key, model, prompt, prefix_caching, timeout)
             else:
-                completion, most_probable, expected_value = get_together_prediction(api_key, model, prompt)
+                return await get_together_completion_async(session, api_key, model, prompt, api_base, prefix_caching)
+
+        return await run_prompts_async(
+            predict,
+            prompts,
+            concurrency=concurrency,
+            requests_per_minute=requests_per_minute or default_requests_per_minute,
+            tokens_per_minute=tokens_per_minute or default_tokens_per_minute,
+            timeout=timeout,
+            max_retries=max_retries,
+            estimate_tokens=estimate_tokens,
+            on_result=on_result,
+            endpoint=model_api,
+            hedger=hedger
+        )
+
+def write_results(records, base_file_path, task, num_prompts, map_renderer="canvas"):
+    records = [records[index] for index in sorted(records) if records[index]['most_probable'] is not None]
+    ev_records = [record for record in records if record['expected_value'] is not None]
+
+    latitudes = [record['latitude'] for record in records]
+    longitudes = [record['longitude'] for record in records]
+    predicted = [record['most_probable'] for record in records]
+
+    write_to_csv(latitudes, longitudes, predicted, f"{base_file_path}.csv")
+    plot_on_map(latitudes, longitudes, predicted, f"{base_file_path}.html", map_renderer)
+
+    summary = {
+        "Task": task,
+        "Prompts": num_prompts,
+        "Answered": len(records),
+        "Answer Rate": len(records) / num_prompts if num_prompts else 0.0,
+        "Mean Prediction": np.mean(predicted) if predicted else None,
+        "Mean Expected Value": None,
+        "Predictions File": f"{base_file_path}.csv"
+    }
 
-            signal.alarm(0)
+    if not ev_records:
+        return summary
 
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            delay = max(MIN_DELAY - elapsed_time, 0)
-            time.sleep(delay)
+    latitudes = [record['latitude'] for record in ev_records]
+    longitudes = [record['longitude'] for record in ev_records]
+    predicted_ev = [record['expected_value'] for record in ev_records]
 
-            print(f"PROMPT {i}:\n\n{prompt}\n\nCOMPLETION: {completion}\n")
+    write_to_csv(latitudes, longitudes, predicted_ev, f"{base_file_path}_expected_value.csv")
+    plot_on_map(latitudes, longitudes, predicted_ev, f"{base_file_path}_expected_value.html", map_renderer)
 
-            if most_probable is None:
-                continue
+    summary["Mean Expected Value"] = np.mean(predicted_ev)
+    return summary
 
-            print(f"RATING: {most_probable}\n")
+def write_usage(usage, elapsed_time, prefix_caching, file_path):
+    usage = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "prefix_caching": prefix_caching,
+        **usage,
+        "uncached_tokens": usage["prompt_tokens"] - usage["cached_tokens"],
+        "cached_fraction": usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0.0,
+        "elapsed_seconds": elapsed_time,
+        "seconds_per_request": elapsed_time / usage["requests"] if usage["requests"] else None
+    }
+
+    with open(file_path, 'a') as file:
+        file.write(json.dumps(usage) + "\n")
 
-            latitudes.append(lat)
-            longitudes.append(lon)
+    print(f"Usage: {usage['requests']} requests, {usage['prompt_tokens']} prompt tokens ({usage['cached_tokens']} cached, {usage['cached_fraction']:.1%}), {usage['completion_tokens']} completion tokens")
 
-            predicted.append(most_probable)
-            write_to_csv(latitudes, longitudes, predicted, f"{base_file_path}.csv")
+def get_file_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
 
-            if expected_value is None:
-                continue
+def print_prediction(i, prompt, completion, most_probable, expected_value):
+    print(f"PROMPT {i}:\n\n{prompt}\n\nCOMPLETION: {completion}\n")
 
-            print(f"EXPECTED VALUE: {expected_value}\n\n")
+    if most_probable is None:
+        return
 
-            predicted_ev.append(expected_value)
-            write_to_csv(latitudes, longitudes, predicted_ev, f"{base_file_path}_expected_value.csv")
+    print(f"RATING: {most_probable}\n")
 
-        except Exception as e:
-            print(f"Error encountered: {e}. Skipping this iteration.")
-            continue
+    if expected_value is None:
+        return
 
-    plot_on_map(latitudes, longitudes, predicted, f"{base_file_path}.html")
-    plot_on_map(latitudes, longitudes, predicted_ev, f"{base_file_path}_expected_value.html")
+    print(f"EXPECTED VALUE: {expected_value}\n\n")
+
+def get_output_paths(model, tasks, prompt_file_path, directory="results"):
+    """Returns the prefix of the per-run files (summary, usage) and the prefix of each task's outputs."""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    model_name = get_file_name(model)
+    prompts_name = get_file_name(prompt_file_path.rstrip("/").split("/")[-1].split(".")[0])
+    base_file_paths = {task: f"{directory}/{model_name}_{get_file_name(task)}_{prompts_name}" for task in tasks}
+    return f"{directory}/{model_name}_{prompts_name}", base_file_paths
+
+def record_prediction(journal, table, task, index, prompt, response, verbose=False, duplicates=()):
+    """Journals the prediction for the prompt at `index`, and for the identical prompts at `duplicates` that do not
+    have one yet."""
+    completion, most_probable, expected_value, distribution = score_completion(response)
+    if verbose:
+        print_prediction(index + 1, prompt, completion, most_probable, expected_value)
+    if most_probable is None:
+        PARSE_FAILURES.inc(task=task)
+
+    for member in [index] + [duplicate for duplicate in duplicates if duplicate != index and duplicate not in journal]:
+        journal.append(
+            member,
+            latitude=float(table["latitudes"][member]),
+            longitude=float(table["longitudes"][member]),
+            completion=completion,
+            most_probable=most_probable,
+            expected_value=expected_value,
+            distribution=distribution
+        )
+        ROWS_WRITTEN.inc(stage="predictions")
+
+def add_usage(usage, response):
+    usage["requests"] += 1
+    for key in USAGE_FIELDS:
+        usage[key] += (response.get('usage') or {}).get(key) or 0
+
+def write_summary(journals, base_file_paths, num_prompts, map_renderer, file_path):
+    summary = pd.DataFrame([
+        write_results(journal.records, base_file_paths[task], task, num_prompts, map_renderer) for task, journal in journals.items()
+    ])
+    summary.to_csv(file_path, index=False)
+    print(summary.to_string(index=False))
+    return summary
+
+def run_tasks_for_data(model_api, model, tasks, prompt_file_path, api_key, concurrency=1, requests_per_minute=None,
+                       tokens_per_minute=None, timeout=TIMEOUT, max_retries=5, api_base=None, cache=None, replay=False,
+                       map_renderer="canvas", batch_size=16, prefix_caching=False, verbose=False, indices=None, table=None,
+                       hedge_quantile=HEDGE_QUANTILE, max_hedge_fraction=MAX_HEDGE_FRACTION):
+    """Predicts every prompt of every task, or only the prompts at `indices`. `table` can be passed to reuse an
+    already loaded prompt table.
+
+    Requests still running after the provider's recent `hedge_quantile` latency are sent again (for at most
+    `max_hedge_fraction` of the requests) and the first response is used.
+    """
+    table = table if table is not None else load_prompt_table(prompt_file_path)
+    num_prompts = len(table["texts"])
+    selected = None if indices is None else set(int(index) for index in indices)
+    duplicates = find_duplicate_groups(table["latitudes"], table["longitudes"], table["texts"])
+    if duplicates:
+        print(f"Prompts: {describe_duplicates(num_prompts, count_unique(num_prompts, duplicates))}. Identical prompts are only sent once.")
+
+    run_file_path, base_file_paths = get_output_paths(model, tasks, prompt_file_path)
+    journals = {task: Journal(f"{base_file_paths[task]}.journal.jsonl") for task in tasks}
+    hedger = Hedger(model_api, hedge_quantile, max_hedge_fraction)
+
+    try:
+        def record_response(task, index, prompt, response):
+            record_prediction(journals[task], table, task, index, prompt, response, verbose, duplicates.get(index, ()))
+
+        pending = []
+        sent = set()
+        for task in tasks:
+            prompts = render_prompts(table, task)
+            done = len(journals[task])
+            if done:
+                print(f"{task}: resuming, {done} of {num_prompts} prompts already done.")
+
+            for index, prompt in enumerate(prompts):
+                if index in journals[task] or (selected is not None and index not in selected):
+                    continue
+                if index in duplicates:
+                    if (task, duplicates[index][0]) in sent:
+                        continue
+                    sent.add((task, duplicates[index][0]))
+
+                response = cache.get(get_cache_key(model_api, model, prompt, prefix_caching, api_base)) if cache else None
+                if response is None:
+                    pending.append((task, index, prompt))
+                else:
+                    record_response(task, index, prompt, response)
+
+        if replay:
+            print(f"Replay mode: skipping {len(pending)} prompts that are not in the cache.")
+            pending = []
+
+        usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        run_start_time = time.time()
+
+        def store_response(task, index, prompt, response):
+            if cache:
+                cache.put(get_cache_key(model_api, model, prompt, prefix_caching, api_base), response)
+            add_usage(usage, response)
+            record_response(task, index, prompt, response)
+
+        if model_api == "local":
+            from local_backend import get_local_completions
+
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                with Timer("local"):
+                    responses = get_local_completions(model, [prompt for _, _, prompt in batch], batch_size, prefix_caching=prefix_caching)
+                for (task, index, prompt), response in zip(batch, responses):
+                    store_response(task, index, prompt, response)
+        elif concurrency > 1:
+            def on_result(position, prompt, response):
+                if response is not None:
+                    store_response(*pending[position], response)
+
+            asyncio.run(get_completions_async(
+                model_api, api_key, model, [prompt for _, _, prompt in pending], concurrency, requests_per_minute,
+                tokens_per_minute, timeout, max_retries, api_base, on_result, prefix_caching, hedger
+            ))
+        else:
+            for task, index, prompt in pending:
+                try:
+                    start_time = time.time()
+
+                    request = functools.partial(get_timed_completion, model_api, api_key, model, prompt, api_base, prefix_caching, timeout)
+                    response = call_with_retries(hedger, request, timeout, max_retries, RETRYABLE_ERRORS)
+
+                    end_time = time.time()
+                    elapsed_time = end_time - start_time
+                    delay = max(MIN_DELAY - elapsed_time, 0)
+                    time.sleep(delay)
+
+                    store_response(task, index, prompt, response)
+
+                except Exception as e:
+                    print(f"Error encountered: {e}. Skipping this iteration.")
+                    continue
+    finally:
+        for journal in journals.values():
+            journal.close()
+        hedger.close()
+
+    write_usage(usage, time.time() - run_start_time, prefix_caching, f"{run_file_path}_usage.jsonl")
+    summary = write_summary(journals, base_file_paths, num_prompts, map_renderer, f"{run_file_path}_summary.csv")
+
+    if cache:
+        stats = cache.stats()
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries, {stats['bytes'] / 1024 ** 2:.1f} MB")
+
+    return summary
+
+def run_task_for_data(model_api, model, task, prompt_file_path, api_key, **kwargs):
+    return run_tasks_for_data(model_api, model, [task], prompt_file_path, api_key, **kwargs)
 
 def main():
     parser = argparse.ArgumentParser(description='Run zero-shot predictions.')
-    parser.add_argument('model_api', type=str, help='The API to use for predictions (openai, google, together)')
-    parser.add_argument('api_key', type=str, help='The API key')
-    parser.add_argument('model', type=str, help='The model to use for predictions')
+    parser.add_argument('model_api', type=str, help='The API to use for predictions (openai, google, together, local)')
+    parser.add_argument('api_key', type=str, help='The API key (ignored for local)')
+    parser.add_argument('model', type=str, help='The model to use for predictions (for local, a Hugging Face model name or path)')
     parser.add_argument('prompts_file', type=str, help='The file containing prompts')
-    parser.add_argument('task', type=str, help='The task for predictions')
+    parser.add_argument('tasks', type=str, nargs='+', help='One or more tasks for predictions')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of in-flight requests. Values above 1 enable the asynchronous engine')
+    parser.add_argument('--requests_per_minute', type=int, help='Request rate limit for the provider (asynchronous engine only)')
+    parser.add_argument('--tokens_per_minute', type=int, help='Token rate limit for the provider (asynchronous engine only)')
+    parser.add_argument('--timeout', type=int, default=TIMEOUT, help='Per-request timeout in seconds')
+    parser.add_argument('--max_retries', type=int, default=5, help='Retries on timeouts, 429 and 5xx responses')
+    parser.add_argument('--hedge_quantile', type=float, default=HEDGE_QUANTILE, help='Send a duplicate of requests that are still running after this quantile of the recent latencies')
+    parser.add_argument('--max_hedge_fraction', type=float, default=MAX_HEDGE_FRACTION, help='Maximum fraction of requests that are hedged (0 to disable hedging)')
+    parser.add_argument('--api_base', type=str, help='Override the provider base URL (e.g. a local OpenAI-compatible server)')
+    parser.add_argument('--cache', type=str, default=CACHE_FILE, help='Path to the on-disk response cache')
+    parser.add_argument('--cache_max_mb', type=int, default=1024, help='Maximum size of the response cache in MB before least recently used entries are evicted')
+    parser.add_argument('--no_cache', action='store_true', help='Do not read from or write to the response cache')
+    parser.add_argument('--replay', action='store_true', help='Only use cached responses and never call the API')
+    parser.add_argument('--prefix_caching', action='store_true', help='Send the constant instructions at the start of every prompt as a separate system message so providers (and the local backend) can cache them')
+    parser.add_argument('--batch_size', type=int, default=16, help='Number of prompts per forward pass (local only)')
+    parser.add_argument('--verbose', action='store_true', help='Print every prompt and completion')
+    parser.add_argument('--metrics_interval', type=float, default=REPORT_INTERVAL, help='Seconds between progress lines with request rate, errors, retries, timeouts, parse failures and latency (0 to disable)')
+    parser.add_argument('--metrics_file', type=str, help='Append a JSON snapshot of every counter and histogram to this file at each progress line')
+    parser.add_argument('--metrics_port', type=int, help='Serve the metrics in the Prometheus text format on this port (at /metrics)')
+    parser.add_argument('--map_renderer', type=str, default='canvas', choices=sorted(RENDERERS), help='How to draw the prediction maps: canvas (one canvas layer, scales to 100k+ points), hexbin (mean rank per hexagon) or markers (one folium marker per point)')
 
     args = parser.parse_args()
 
+    if args.replay and args.no_cache:
+        parser.error("--replay only uses cached responses and cannot be combined with --no_cache")
+
     model_api = args.model_api
     api_key = args.api_key
     model = args.model
-    task = args.task
+    tasks = args.tasks
     prompt_file = args.prompts_file
 
-    run_task_for_data(model_api, model, task, prompt_file, api_key)
+    cache = None if args.no_cache else DiskCache(args.cache, max_bytes=args.cache_max_mb * 1024 ** 2, read_only=args.replay)
+
+    try:
+        with MetricsReporter(args.metrics_interval, args.metrics_file, args.metrics_port):
+            run_tasks_for_data(
+                model_api, model, tasks, prompt_file, api_key,
+                concurrency=args.concurrency,
+                requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute,
+                timeout=args.timeout,
+                max_retries=args.max_retries,
+                api_base=args.api_base,
+                cache=cache,
+                replay=args.replay,
+                map_renderer=args.map_renderer,
+                batch_size=args.batch_size,
+                prefix_caching=args.prefix_caching,
+                verbose=args.verbose,
+                hedge_quantile=args.hedge_quantile,
+                max_hedge_fraction=args.max_hedge_fraction
+            )
+    finally:
+        if cache:
+            cache.close()
 
 if __name__ == "__main__":
     main()
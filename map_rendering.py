@@ -0,0 +1,180 @@
+import base64
+import json
+import numpy as np
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+
+RANK_COLORS = ['red', 'yellow', 'green']
+PALETTE_SIZE = 256
+MARKER_RADIUS = 7
+FILL_OPACITY = 0.75
+HEXBIN_SIZE_IN_KM = 50
+WEB_MERCATOR_RADIUS = 6378137.0
+
+def get_rank_colormap():
+    return folium.LinearColormap(colors=RANK_COLORS, vmin=0.0, vmax=1.0)
+
+def get_colors(colormap, values):
+    values = np.asarray(values, dtype=np.float64)
+    index = np.asarray(colormap.index, dtype=np.float64)
+    colors = np.asarray(colormap.colors, dtype=np.float64)
+    channels = np.stack([np.interp(values, index, colors[:, channel]) for channel in range(4)], axis=-1)
+    return np.round(channels * 255).astype(np.uint8)
+
+def to_hex(colors):
+    return ['#%02x%02x%02x%02x' % tuple(color) for color in colors]
+
+def encode_array(array):
+    return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode("ascii")
+
+class CanvasPoints(MacroElement):
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            function decode(data, type) {
+                var bytes = Uint8Array.from(atob(data), function(c) { return c.charCodeAt(0); });
+                return new type(bytes.buffer);
+            }
+
+            var coordinates = decode("{{ this.coordinates }}", Float32Array);
+            var colors = decode("{{ this.colors }}", Uint8Array);
+            var palette = {{ this.palette }};
+
+            var CanvasPoints = L.Layer.extend({
+                onAdd: function(map) {
+                    this._map = map;
+                    this._canvas = L.DomUtil.create('canvas', 'leaflet-layer');
+                    map.getPanes().overlayPane.appendChild(this._canvas);
+                    map.on('moveend zoomend resize', this._redraw, this);
+                    this._redraw();
+                },
+
+                onRemove: function(map) {
+                    map.off('moveend zoomend resize', this._redraw, this);
+                    L.DomUtil.remove(this._canvas);
+                },
+
+                _redraw: function() {
+                    var map = this._map;
+                    var size = map.getSize();
+                    var radius = {{ this.radius }};
+
+                    L.DomUtil.setPosition(this._canvas, map.containerPointToLayerPoint([0, 0]));
+                    this._canvas.width = size.x;
+                    this._canvas.height = size.y;
+
+                    var hexagonSize = {{ this.hexagon_size }};
+                    if (hexagonSize) {
+                        radius = hexagonSize * 256 * Math.pow(2, map.getZoom()) / (2 * Math.PI * {{ this.earth_radius }});
+                    }
+
+                    var context = this._canvas.getContext('2d');
+                    context.globalAlpha = {{ this.opacity }};
+
+                    for (var i = 0; i < colors.length; i++) {
+                        var point = map.latLngToContainerPoint([coordinates[2 * i], coordinates[2 * i + 1]]);
+                        if (point.x < -radius || point.y < -radius || point.x > size.x + radius || point.y > size.y + radius) {
+                            continue;
+                        }
+                        context.fillStyle = palette[colors[i]];
+                        context.beginPath();
+                        if (hexagonSize) {
+                            for (var corner = 0; corner < 6; corner++) {
+                                var angle = Math.PI / 180 * (60 * corner + 30);
+                                context.lineTo(point.x + radius * Math.cos(angle), point.y - radius * Math.sin(angle));
+                            }
+                            context.closePath();
+                        } else {
+                            context.arc(point.x, point.y, radius, 0, 2 * Math.PI);
+                        }
+                        context.fill();
+                    }
+                }
+            });
+
+            new CanvasPoints().addTo({{ this._parent.get_name() }});
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, latitudes, longitudes, colors, palette, radius=MARKER_RADIUS, opacity=FILL_OPACITY, hexagon_size=None):
+        super().__init__()
+        self._name = "CanvasPoints"
+        coordinates = np.column_stack([latitudes, longitudes]).astype(np.float32)
+        self.coordinates = encode_array(coordinates)
+        self.colors = encode_array(np.asarray(colors, dtype=np.uint8))
+        self.palette = json.dumps(palette)
+        self.radius = radius
+        self.opacity = opacity
+        self.hexagon_size = hexagon_size or 0
+        self.earth_radius = WEB_MERCATOR_RADIUS
+
+def get_palette_indices(data):
+    return np.round(np.clip(data, 0.0, 1.0) * (PALETTE_SIZE - 1)).astype(np.uint8)
+
+def get_palette(colormap):
+    return to_hex(get_colors(colormap, np.linspace(0.0, 1.0, PALETTE_SIZE)))
+
+def add_canvas_points(m, latitudes, longitudes, data, colormap):
+    m.add_child(CanvasPoints(latitudes, longitudes, get_palette_indices(data), get_palette(colormap)))
+
+def add_markers(m, latitudes, longitudes, data, colormap):
+    for lat, lon, color in zip(latitudes, longitudes, to_hex(get_colors(colormap, data))):
+        folium.CircleMarker(
+            location=(lat, lon),
+            radius=MARKER_RADIUS,
+            color='none',
+            fill=True,
+            fill_color=color,
+            fill_opacity=FILL_OPACITY
+        ).add_to(m)
+
+def to_web_mercator(latitudes, longitudes):
+    latitudes = np.clip(latitudes, -85.05112878, 85.05112878)
+    x = WEB_MERCATOR_RADIUS * np.radians(longitudes)
+    y = WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(latitudes) / 2))
+    return x, y
+
+def from_web_mercator(x, y):
+    longitudes = np.degrees(x / WEB_MERCATOR_RADIUS)
+    latitudes = np.degrees(2 * np.arctan(np.exp(y / WEB_MERCATOR_RADIUS)) - np.pi / 2)
+    return latitudes, longitudes
+
+def hexbin(latitudes, longitudes, data, size_in_km=HEXBIN_SIZE_IN_KM):
+    # Pointy-top hexagons on a Web Mercator grid so cells look regular on the map; the size is in km at the equator.
+    size = size_in_km * 1000
+    x, y = to_web_mercator(np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64))
+
+    q = (np.sqrt(3) / 3 * x - y / 3) / size
+    r = (2 / 3 * y) / size
+    s = -q - r
+
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq[fix_q] = -rr[fix_q] - rs[fix_q]
+    rr[fix_r] = -rq[fix_r] - rs[fix_r]
+
+    cells, inverse, counts = np.unique(np.column_stack([rq, rr]), axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    means = np.bincount(inverse, weights=np.asarray(data, dtype=np.float64), minlength=len(cells)) / counts
+
+    center_x = size * np.sqrt(3) * (cells[:, 0] + cells[:, 1] / 2)
+    center_y = size * 1.5 * cells[:, 1]
+    center_lats, center_lons = from_web_mercator(center_x, center_y)
+
+    return center_lats, center_lons, means, counts
+
+def add_hexbins(m, latitudes, longitudes, data, colormap, size_in_km=HEXBIN_SIZE_IN_KM):
+    center_lats, center_lons, means, _ = hexbin(latitudes, longitudes, data, size_in_km)
+    m.add_child(CanvasPoints(
+        center_lats, center_lons, get_palette_indices(means), get_palette(colormap), hexagon_size=size_in_km * 1000
+    ))
+
+RENDERERS = {
+    "canvas": add_canvas_points,
+    "markers": add_markers,
+    "hexbin": add_hexbins
+}
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import numpy as np
+import rasterio
+from tqdm import tqdm
+from utils import ADJACENT_PIXELS, get_neighborhood_sums_files, load_neighborhood_sums, neighborhood_sums, summed_area_table
+
+STRIP_HEIGHT = 128
+
+def strip_neighborhood_sums(src, row_start, row_stop):
+    read_start, read_stop = max(row_start - ADJACENT_PIXELS, 0), min(row_stop + ADJACENT_PIXELS, src.height)
+    table = summed_area_table(src.read(1, window=((read_start, read_stop), (0, src.width))))
+    rows = np.arange(row_start, row_stop)[:, None] - read_start
+    cols = np.arange(src.width)[None, :]
+    return neighborhood_sums(table, rows, cols)
+
+def preprocess_raster(file_path, dtype="float64", strip_height=STRIP_HEIGHT, force=False):
+    """Writes the sum of the (2 * ADJACENT_PIXELS + 1)^2 window around every pixel of the raster to a .npy file next
+    to it, with a JSON sidecar holding the transform and the raster's size and modification time.
+
+    extract_data_batch memory-maps the file and looks points up directly as long as the raster has not changed.
+    """
+    sums_file, metadata_file = get_neighborhood_sums_files(file_path)
+    if not force and load_neighborhood_sums(file_path) is not None:
+        print(f"{sums_file} is up to date")
+        return sums_file
+
+    stat = os.stat(file_path)
+    with rasterio.open(file_path) as src:
+        temporary_path = f"{sums_file}.{os.getpid()}.tmp"
+        sums = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=dtype, shape=(src.height, src.width))
+        for row_start in tqdm(range(0, src.height, strip_height), desc=os.path.basename(file_path)):
+            row_stop = min(row_start + strip_height, src.height)
+            sums[row_start:row_stop] = strip_neighborhood_sums(src, row_start, row_stop)
+        sums.flush()
+        del sums
+        os.replace(temporary_path, sums_file)
+
+        metadata = {
+            "source": os.path.basename(file_path),
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "adjacent_pixels": ADJACENT_PIXELS,
+            "transform": list(src.transform)[:6],
+            "width": src.width,
+            "height": src.height,
+            "dtype": dtype
+        }
+
+    temporary_path = f"{metadata_file}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(metadata, file, indent=4)
+    os.replace(temporary_path, metadata_file)
+
+    print(f"Wrote {sums_file} ({os.path.getsize(sums_file) / 1024 ** 3:.2f} GB)")
+    return sums_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the neighborhood sums of GeoTIFF files so ground truth lookups are a single array index.")
+    parser.add_argument("tifs", type=str, nargs="+", help="Paths to the tif files.")
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"], help="Precision of the stored sums. float32 halves the file size.")
+    parser.add_argument("--strip_height", type=int, default=STRIP_HEIGHT, help="Number of raster rows processed at once.")
+    parser.add_argument("--force", action="store_true", help="Recompute the sums even if they are up to date.")
+
+    args = parser.parse_args()
+
+    for file_path in args.tifs:
+        preprocess_raster(file_path, args.dtype, args.strip_height, args.force)
+
+if __name__ == "__main__":
+    main()
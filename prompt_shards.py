@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import time
+import concurrent.futures
+
+MANIFEST_FILE = "manifest.json"
+
+def get_shard_bounds(num_rows, num_shards):
+    return [(shard * num_rows // num_shards, (shard + 1) * num_rows // num_shards) for shard in range(num_shards)]
+
+def get_shards_dir(output_file):
+    return f"{output_file}.shards"
+
+def get_part_file(shards_dir, shard):
+    return os.path.join(shards_dir, f"part-{shard:05d}.jsonl")
+
+def get_marker_file(shards_dir, shard):
+    return os.path.join(shards_dir, f"part-{shard:05d}.done")
+
+def write_json(file_path, data):
+    temporary_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(data, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, file_path)
+
+def read_json(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r") as file:
+        return json.load(file)
+
+def load_manifest(shards_dir, source, num_rows, num_shards):
+    """Reads the manifest of a sharded run, creating it on the first run.
+
+    Shards are contiguous row ranges, so they only line up between runs (and nodes) with the same rows and shard count.
+    """
+    manifest = read_json(os.path.join(shards_dir, MANIFEST_FILE))
+    if manifest is None:
+        if not os.path.exists(shards_dir):
+            os.makedirs(shards_dir, exist_ok=True)
+        manifest = {
+            "source": source,
+            "rows": num_rows,
+            "num_shards": num_shards,
+            "shards": [
+                {"shard": shard, "start": start, "stop": stop, "file": os.path.basename(get_part_file(shards_dir, shard)), "complete": False}
+                for shard, (start, stop) in enumerate(get_shard_bounds(num_rows, num_shards))
+            ]
+        }
+        write_json(os.path.join(shards_dir, MANIFEST_FILE), manifest)
+    elif manifest["rows"] != num_rows or manifest["num_shards"] != num_shards:
+        raise ValueError(f"{shards_dir} was created for {manifest['rows']} rows in {manifest['num_shards']} shards, not {num_rows} rows in {num_shards} shards")
+
+    return manifest
+
+def update_manifest(shards_dir):
+    """Refreshes the manifest from the per-shard completion markers, which are the source of truth.
+
+    Every process only writes its own markers, so shards can finish on different nodes at the same time.
+    """
+    manifest = read_json(os.path.join(shards_dir, MANIFEST_FILE))
+    for entry in manifest["shards"]:
+        marker = read_json(get_marker_file(shards_dir, entry["shard"]))
+        entry["complete"] = marker is not None
+        if marker:
+            entry.update(marker)
+    write_json(os.path.join(shards_dir, MANIFEST_FILE), manifest)
+    return manifest
+
+def run_shard(worker, coordinates, shards_dir, shard, worker_kwargs):
+    start_time = time.time()
+    prompts = worker(coordinates, get_part_file(shards_dir, shard), **worker_kwargs)
+    marker = {"prompts": prompts, "failed": len(coordinates) - prompts, "seconds": time.time() - start_time, "completed_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    # A shard with failed rows stays incomplete, so the next run redoes it and merge_shards refuses it.
+    if marker["failed"] == 0:
+        write_json(get_marker_file(shards_dir, shard), marker)
+    return marker
+
+def run_shards(worker, coordinates, output_file, num_shards, shards=None, processes=1, force=False, source=None, **worker_kwargs):
+    """Runs `worker(shard_coordinates, part_file, **worker_kwargs)` for each selected shard in a process pool.
+
+    The worker returns the number of prompts it wrote. A shard is only complete if it wrote a prompt for every row.
+    Shards that are already complete are skipped unless `force`.
+    Returns the refreshed manifest.
+    """
+    shards_dir = get_shards_dir(output_file)
+    manifest = load_manifest(shards_dir, source, len(coordinates), num_shards)
+
+    selected = range(num_shards) if shards is None else shards
+    invalid = [shard for shard in selected if not 0 <= shard < num_shards]
+    if invalid:
+        raise ValueError(f"Shard indices must be between 0 and {num_shards - 1}, got {', '.join(map(str, invalid))}")
+    pending = [shard for shard in selected if force or not os.path.exists(get_marker_file(shards_dir, shard))]
+    skipped = len(selected) - len(pending)
+    if skipped:
+        print(f"Skipping {skipped} complete shards")
+
+    for shard in pending:
+        if os.path.exists(get_marker_file(shards_dir, shard)):
+            os.remove(get_marker_file(shards_dir, shard))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {}
+        for shard in pending:
+            entry = manifest["shards"][shard]
+            future = executor.submit(run_shard, worker, coordinates[entry["start"]:entry["stop"]], shards_dir, shard, worker_kwargs)
+            futures[future] = shard
+
+        for future in concurrent.futures.as_completed(futures):
+            shard = futures[future]
+            try:
+                marker = future.result()
+                if marker["failed"]:
+                    print(f"Shard {shard} incomplete: {marker['prompts']} prompts, {marker['failed']} failed. Rerun it with --shards {shard}")
+                else:
+                    print(f"Shard {shard} complete: {marker['prompts']} prompts")
+            except Exception as e:
+                print(f"Shard {shard} failed: {e!r}. Rerun it with --shards {shard}")
+
+    return update_manifest(shards_dir)
+
+def merge_shards(output_file):
+    """Concatenates the part files in shard order into `output_file`, once every shard is complete."""
+    shards_dir = get_shards_dir(output_file)
+    manifest = update_manifest(shards_dir)
+    incomplete = [entry["shard"] for entry in manifest["shards"] if not entry["complete"]]
+    if incomplete:
+        raise ValueError(f"Cannot merge {output_file}: shards {', '.join(map(str, incomplete))} are not complete")
+
+    temporary_path = f"{output_file}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as output:
+        for entry in manifest["shards"]:
+            with open(get_part_file(shards_dir, entry["shard"]), "rb") as part:
+                shutil.copyfileobj(part, output)
+    os.replace(temporary_path, output_file)
+
+    return sum(entry["prompts"] for entry in manifest["shards"])
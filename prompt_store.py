@@ -0,0 +1,140 @@
+import argparse
+import json
+import mmap
+import os
+import re
+import jsonlines
+import numpy as np
+
+PROMPT_PATTERN = re.compile(r'Coordinates: \((?P<latitude>[-\d.]+), (?P<longitude>[-\d.]+)\)\n\nAddress: "(?P<address>.*?)"\n\nNearby Places:\n"\n(?P<nearby_places>.*)"\n\n<TASK> \(On a Scale from 0\.0 to 9\.9\):', re.DOTALL)
+TEXT_COLUMNS = ["address", "nearby_places"]
+
+def render_prompt_text(latitude, longitude, address, nearby_places):
+    return f"Coordinates: ({latitude:.5f}, {longitude:.5f})\n\nAddress: \"{address}\"\n\nNearby Places:\n\"\n{nearby_places}\"\n\n<TASK> (On a Scale from 0.0 to 9.9):"
+
+def is_prompt_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+def encode_column(values):
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return b"".join(encoded), offsets
+
+def map_file(file_path):
+    with open(file_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def convert_prompts(input_file, output_dir):
+    latitudes, longitudes = [], []
+    columns = {column: [] for column in TEXT_COLUMNS}
+
+    with jsonlines.open(input_file, 'r') as reader:
+        for index, item in enumerate(reader):
+            text = item['text'].strip()
+            match = PROMPT_PATTERN.fullmatch(text)
+            if not match:
+                raise ValueError(f"Prompt {index + 1} does not follow the GeoLLM prompt format")
+
+            latitude, longitude = float(match['latitude']), float(match['longitude'])
+            if render_prompt_text(latitude, longitude, match['address'], match['nearby_places']) != text:
+                raise ValueError(f"Prompt {index + 1} cannot be reproduced from its columns")
+
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            for column in TEXT_COLUMNS:
+                columns[column].append(match[column])
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    np.save(os.path.join(output_dir, "latitudes.npy"), np.array(latitudes, dtype=np.float64))
+    np.save(os.path.join(output_dir, "longitudes.npy"), np.array(longitudes, dtype=np.float64))
+    for column in TEXT_COLUMNS:
+        data, offsets = encode_column(columns[column])
+        with open(os.path.join(output_dir, f"{column}.bin"), "wb") as file:
+            file.write(data)
+        np.save(os.path.join(output_dir, f"{column}_offsets.npy"), offsets)
+
+    with open(os.path.join(output_dir, "meta.json"), "w") as file:
+        json.dump({"version": 1, "count": len(latitudes), "source": os.path.basename(input_file)}, file)
+
+    return len(latitudes)
+
+def load_prompt_store(path):
+    store = {
+        "latitudes": np.load(os.path.join(path, "latitudes.npy"), mmap_mode='r'),
+        "longitudes": np.load(os.path.join(path, "longitudes.npy"), mmap_mode='r')
+    }
+    for column in TEXT_COLUMNS:
+        store[column] = map_file(os.path.join(path, f"{column}.bin"))
+        store[f"{column}_offsets"] = np.load(os.path.join(path, f"{column}_offsets.npy"), mmap_mode='r')
+    return store
+
+def get_text(store, column, index):
+    offsets = store[f"{column}_offsets"]
+    return store[column][offsets[index]:offsets[index + 1]].decode("utf-8")
+
+def get_prompt_text(store, index):
+    return render_prompt_text(
+        float(store["latitudes"][index]),
+        float(store["longitudes"][index]),
+        get_text(store, "address", index),
+        get_text(store, "nearby_places", index)
+    )
+
+class PromptTexts:
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store["latitudes"])
+
+    def __getitem__(self, index):
+        return get_prompt_text(self.store, index)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+def find_rows(store, column, needle):
+    buffer = store[column]
+    offsets = store[f"{column}_offsets"]
+    rows = np.zeros(len(offsets) - 1, dtype=bool)
+    if not needle:
+        rows[:] = True
+        return rows
+
+    needle = needle.encode("utf-8")
+    position = buffer.find(needle, int(offsets[0]))
+    while position != -1:
+        row = np.searchsorted(offsets, position, side="right") - 1
+        if position + len(needle) <= offsets[row + 1]:
+            rows[row] = True
+            position = buffer.find(needle, int(offsets[row + 1]))
+        else:
+            position = buffer.find(needle, position + 1)
+    return rows
+
+# Only the address and nearby places are searched. Unlike filtering the raw JSON lines of a prompt file, regions do not
+# match the coordinates, the fixed prompt text or JSON escapes.
+def filter_regions(store, regions):
+    rows = np.zeros(len(store["latitudes"]), dtype=bool)
+    for region in regions:
+        for column in TEXT_COLUMNS:
+            rows |= find_rows(store, column, region)
+    return np.nonzero(rows)[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a GeoLLM prompts JSONL file into a columnar prompt store.")
+    parser.add_argument("prompts_file", type=str, help="Path to the input prompts JSONL file.")
+    parser.add_argument("output_dir", type=str, help="Directory to write the prompt store to (e.g. prompts/100000_prompts.store).")
+
+    args = parser.parse_args()
+
+    count = convert_prompts(args.prompts_file, args.output_dir)
+    print(f"Wrote {count} prompts to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
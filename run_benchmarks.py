@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import jsonlines
+import numpy as np
+import pandas as pd
+import psutil
+import rasterio
+import requests
+from rasterio.transform import from_bounds
+from scipy import ndimage
+import generate_geollm_prompts_with_csv as geollm_prompts
+from fake_servers import DEFAULT_PORT, get_fake_address, get_urls, start_fake_server
+from make_predictions_and_visualize import run_task_for_data
+from prompt_store import render_prompt_text
+from rate_limiting import RateLimiter
+from select_visualization_prompts import select_spread_out_points_with_importance_sampling
+from utils import extract_data, extract_data_batch
+
+BENCHMARK_DIR = "benchmark_data"
+STAGES = ["extract_data", "sampler", "get_prompts", "run_task_for_data"]
+SCALES = [1000, 10000]
+
+# Global 30 arc-second grid of the WorldPop 1km aggregated rasters and a 2.5 arc-minute grid like the infant mortality
+# rasters, both over the same latitude range. --raster_scale shrinks them proportionally.
+BOUNDS = (-180.0, -72.0, 180.0, 84.0)
+WORLDPOP_SHAPE = (18720, 43200)
+IMR_SHAPE = (3744, 8640)
+WORLDPOP_NODATA = -99999.0
+IMR_NODATA = -9999.0
+LAND_FRACTION = 0.3
+FIELD_SHAPE = (90, 180)
+STRIP_HEIGHT = 256
+
+TASK = "Population Density"
+COMPASS_DIRECTIONS = geollm_prompts.COMPASS_DIRECTIONS
+
+def smooth_field(rng, shape=FIELD_SHAPE, sigma=3):
+    field = ndimage.gaussian_filter(rng.standard_normal(shape), sigma=sigma, mode="wrap")
+    return (field - field.mean()) / field.std()
+
+def sample_field(field, latitudes, longitudes):
+    rows = (BOUNDS[3] - latitudes) / (BOUNDS[3] - BOUNDS[1]) * (field.shape[0] - 1)
+    cols = (longitudes - BOUNDS[0]) / (BOUNDS[2] - BOUNDS[0]) * (field.shape[1] - 1)
+    return ndimage.map_coordinates(field, [rows, cols], order=1, mode="nearest")
+
+def get_fields(seed):
+    rng = np.random.default_rng(seed)
+    land, density, mortality = smooth_field(rng), smooth_field(rng), smooth_field(rng)
+    return np.quantile(land, 1 - LAND_FRACTION), land, density, mortality
+
+def write_synthetic_raster(file_path, shape, nodata, values, seed):
+    height, width = shape
+    transform = from_bounds(*BOUNDS, width, height)
+    rng = np.random.default_rng(seed)
+    profile = {
+        "driver": "GTiff", "height": height, "width": width, "count": 1, "dtype": "float32", "crs": "EPSG:4326",
+        "transform": transform, "nodata": nodata, "tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate"
+    }
+
+    longitudes = (transform * (np.arange(width) + 0.5, np.zeros(width)))[0]
+    with rasterio.open(file_path, "w", **profile) as dst:
+        for row_start in range(0, height, STRIP_HEIGHT):
+            rows = np.arange(row_start, min(row_start + STRIP_HEIGHT, height))
+            latitudes = (transform * (np.zeros(len(rows)), rows + 0.5))[1]
+            lat_grid, lon_grid = np.meshgrid(latitudes, longitudes, indexing="ij")
+            data = values(rng, lat_grid.ravel(), lon_grid.ravel()).reshape(lat_grid.shape)
+            data = np.where(np.isnan(data), nodata, data).astype(np.float32)
+            dst.write(data, 1, window=((rows[0], rows[-1] + 1), (0, width)))
+
+def make_rasters(data_dir, raster_scale, seed):
+    threshold, land, density, mortality = get_fields(seed)
+    worldpop_shape = tuple(max(int(size * raster_scale), 1) for size in WORLDPOP_SHAPE)
+    imr_shape = tuple(max(int(size * raster_scale), 1) for size in IMR_SHAPE)
+    worldpop_tif = os.path.join(data_dir, f"worldpop_{worldpop_shape[1]}x{worldpop_shape[0]}_seed{seed}.tif")
+    imr_tif = os.path.join(data_dir, f"imr_{imr_shape[1]}x{imr_shape[0]}_seed{seed}.tif")
+
+    def population(rng, latitudes, longitudes):
+        on_land = sample_field(land, latitudes, longitudes) > threshold
+        people = np.exp(1.5 * sample_field(density, latitudes, longitudes) + rng.normal(0, 1.0, len(latitudes)))
+        return np.where(on_land, people, np.nan)
+
+    def infant_mortality(rng, latitudes, longitudes):
+        on_land = sample_field(land, latitudes, longitudes) > threshold
+        rates = np.clip(40 + 25 * sample_field(mortality, latitudes, longitudes) + rng.normal(0, 5, len(latitudes)), 1, 150)
+        return np.where(on_land, rates, np.nan)
+
+    for file_path, shape, nodata, values in [(worldpop_tif, worldpop_shape, WORLDPOP_NODATA, population), (imr_tif, imr_shape, IMR_NODATA, infant_mortality)]:
+        if not os.path.exists(file_path):
+            print(f"Writing {file_path}")
+            write_synthetic_raster(file_path + ".tmp", shape, nodata, values, seed)
+            os.replace(file_path + ".tmp", file_path)
+
+    return worldpop_tif, imr_tif
+
+def make_coordinates(num_points, seed):
+    threshold, land, _, _ = get_fields(seed)
+    rng = np.random.default_rng(seed + num_points)
+    coordinates = np.zeros((0, 2))
+    while len(coordinates) < num_points:
+        latitudes = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(BOUNDS[1])), np.sin(np.radians(BOUNDS[3])), 4 * num_points)))
+        longitudes = rng.uniform(BOUNDS[0], BOUNDS[2], 4 * num_points)
+        on_land = sample_field(land, latitudes, longitudes) > threshold
+        coordinates = np.concatenate([coordinates, np.column_stack([latitudes, longitudes])[on_land]])
+    return np.round(coordinates[:num_points], 5)
+
+def get_nearby_places_text(rng):
+    places = sorted((rng.uniform(0.5, geollm_prompts.MAXIMUM_RADIUS_IN_KM), rng.choice(COMPASS_DIRECTIONS), f"Place {rng.integers(100000)}")
+                    for _ in range(rng.integers(0, geollm_prompts.MAXIMUM_NEARBY_PLACES + 1)))
+    return "".join(f"{distance:.1f} km {direction}: {name}\n" for distance, direction, name in places)
+
+def make_prompts(data_dir, num_points, seed):
+    file_path = os.path.join(data_dir, f"prompts_{num_points}_seed{seed}.jsonl")
+    if os.path.exists(file_path):
+        return file_path
+
+    print(f"Writing {file_path}")
+    rng = np.random.default_rng(seed)
+    with jsonlines.open(file_path + ".tmp", "w") as writer:
+        for lat, lon in make_coordinates(num_points, seed):
+            address = get_fake_address(lat, lon)
+            address = ", ".join(value for key, value in address.items() if "-" not in key and "number" not in key and "code" not in key)
+            writer.write({"text": render_prompt_text(lat, lon, address, get_nearby_places_text(rng))})
+    os.replace(file_path + ".tmp", file_path)
+    return file_path
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q) * 1000) if len(latencies) else np.nan
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+# Samples the resident set size in a thread, since tracemalloc misses GDAL's buffers and slows down threads.
+class PeakMemory:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.stopped = threading.Event()
+
+    def sample(self):
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        self.growth = self.peak - self.start
+
+def measure(stage, num_points, run):
+    start_time = time.perf_counter()
+    with PeakMemory() as memory, quiet():
+        items, latencies, errors = run()
+    seconds = time.perf_counter() - start_time
+
+    result = {
+        "Stage": stage,
+        "Scale": num_points,
+        "Items": items,
+        "Seconds": seconds,
+        "Items per Second": items / seconds if seconds else np.nan,
+        "p50 ms": percentile_ms(latencies, 50),
+        "p99 ms": percentile_ms(latencies, 99),
+        "Peak Memory MB": memory.growth / 1024 ** 2,
+        "Errors": errors
+    }
+    print(f"{stage} ({num_points}): {items} items in {seconds:.2f}s, {result['Items per Second']:.1f}/s, "
+          f"p50 {result['p50 ms']:.1f} ms, p99 {result['p99 ms']:.1f} ms, peak {result['Peak Memory MB']:.1f} MB, {errors} errors")
+    return result
+
+def timed_calls(function, arguments):
+    latencies = []
+    for argument in arguments:
+        start_time = time.perf_counter()
+        function(*argument)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+def get_server_stats(port, endpoints):
+    stats = requests.get(get_urls(port)["stats"], timeout=10).json()
+    latencies = [latency for endpoint in endpoints for latency in stats["latencies"].get(endpoint, [])]
+    errors = sum(stats["errors"].get(endpoint, 0) for endpoint in endpoints)
+    return latencies, errors
+
+def reset_server(port):
+    requests.post(get_urls(port)["reset"], timeout=10)
+
+def benchmark_extract_data(coordinates, worldpop_tif, imr_tif, repeats, single_lookups):
+    def run_batch():
+        latencies = timed_calls(lambda: [extract_data_batch(coordinates, tif) for tif in (worldpop_tif, imr_tif)], [()] * repeats)
+        return repeats * 2 * len(coordinates), latencies, 0
+
+    def run_single():
+        sample = coordinates[:single_lookups]
+        return len(sample), timed_calls(lambda lat, lon: extract_data(lat, lon, worldpop_tif), sample), 0
+
+    return [measure("extract_data_batch", len(coordinates), run_batch), measure("extract_data", len(coordinates), run_single)]
+
+def benchmark_sampler(coordinates, worldpop_tif, repeats, seed):
+    populations = np.nan_to_num(extract_data_batch(coordinates, worldpop_tif))
+    num_points = min(2000, len(coordinates) // 5)
+
+    def run():
+        latencies = timed_calls(lambda: select_spread_out_points_with_importance_sampling(coordinates, populations, num_points, seed=seed), [()] * repeats)
+        return repeats * num_points, latencies, 0
+
+    return [measure("sampler", len(coordinates), run)]
+
+def benchmark_get_prompts(coordinates, port):
+    urls = get_urls(port)
+    geollm_prompts.NOMINATIM_URL, geollm_prompts.OVERPASS_URL = urls["nominatim"], urls["overpass"]
+    geollm_prompts.RATE_LIMITERS["nominatim"] = RateLimiter()
+    geollm_prompts.RATE_LIMITERS["overpass"] = RateLimiter()
+    reset_server(port)
+
+    def run():
+        prompts = geollm_prompts.get_prompts([tuple(point) for point in coordinates], cache_file=None)
+        latencies, errors = get_server_stats(port, ["nominatim", "overpass"])
+        return sum(1 for prompt in prompts if prompt), latencies, errors
+
+    return [measure("get_prompts", len(coordinates), run)]
+
+def benchmark_run_task_for_data(prompt_file, num_points, port, concurrency):
+    reset_server(port)
+    work_dir = tempfile.mkdtemp(prefix="geollm_benchmark_")
+    prompt_file = os.path.abspath(prompt_file)
+    current_dir = os.getcwd()
+
+    def run():
+        os.chdir(work_dir)
+        try:
+            summary = run_task_for_data(
+                "openai", "benchmark-model", TASK, prompt_file, "benchmark",
+                concurrency=concurrency, requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12, api_base=get_urls(port)["openai"]
+            )
+        finally:
+            os.chdir(current_dir)
+        latencies, errors = get_server_stats(port, ["openai"])
+        return int(summary["Answered"].iloc[0]), latencies, errors
+
+    try:
+        return [measure("run_task_for_data", num_points, run)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_benchmarks(stages, scales, data_dir=BENCHMARK_DIR, raster_scale=0.25, repeats=3, single_lookups=200, port=DEFAULT_PORT,
+                   latency_ms=20.0, jitter_ms=10.0, error_rate=0.01, concurrency=64, seed=0, slow_rate=0.0, slow_ms=1000.0):
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+
+    worldpop_tif, imr_tif = make_rasters(data_dir, raster_scale, seed)
+    server = None
+    if {"get_prompts", "run_task_for_data"} & set(stages):
+        server = start_fake_server(port, latency_ms=latency_ms, jitter_ms=jitter_ms, error_rate=error_rate, seed=seed, slow_rate=slow_rate, slow_ms=slow_ms)
+
+    results = []
+    try:
+        for num_points in scales:
+            coordinates = make_coordinates(num_points, seed)
+            if "extract_data" in stages:
+                results += benchmark_extract_data(coordinates, worldpop_tif, imr_tif, repeats, single_lookups)
+            if "sampler" in stages:
+                results += benchmark_sampler(coordinates, worldpop_tif, repeats, seed)
+            if "get_prompts" in stages:
+                results += benchmark_get_prompts(coordinates, port)
+            if "run_task_for_data" in stages:
+                results += benchmark_run_task_for_data(make_prompts(data_dir, num_points, seed), num_points, port, concurrency)
+    finally:
+        if server:
+            server.terminate()
+            server.join()
+
+    return pd.DataFrame(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the raster, sampling, prompt generation and prediction stages on synthetic data and local fake servers.")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES, help="Stages to benchmark.")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES, help="Numbers of coordinates / prompts to benchmark each stage with (e.g. 1000 10000 100000).")
+    parser.add_argument("--data_dir", type=str, default=BENCHMARK_DIR, help="Folder for the synthetic rasters and prompt files. They are reused between runs.")
+    parser.add_argument("--raster_scale", type=float, default=0.25, help="Size of the synthetic rasters relative to the real ones (1.0 is the full 43200x18720 WorldPop grid).")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs of the single-call stages (extract_data_batch and the sampler).")
+    parser.add_argument("--single_lookups", type=int, default=200, help="Number of one-point extract_data calls to time.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port for the fake Nominatim, Overpass and OpenAI server.")
+    parser.add_argument("--latency_ms", type=float, default=20.0, help="Base latency of the fake server.")
+    parser.add_argument("--jitter_ms", type=float, default=10.0, help="Random extra latency of the fake server.")
+    parser.add_argument("--error_rate", type=float, default=0.01, help="Fraction of fake server requests that get a 429 response.")
+    parser.add_argument("--slow_rate", type=float, default=0.0, help="Fraction of fake server requests that take --slow_ms longer, to measure tail latency.")
+    parser.add_argument("--slow_ms", type=float, default=1000.0, help="Extra latency of the slow fake server requests.")
+    parser.add_argument("--concurrency", type=int, default=64, help="Number of in-flight requests for run_task_for_data.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data.")
+    parser.add_argument("--output", type=str, default=os.path.join(BENCHMARK_DIR, "results.csv"), help="Where to write the results table.")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.stages,
+        args.scales,
+        data_dir=args.data_dir,
+        raster_scale=args.raster_scale,
+        repeats=args.repeats,
+        single_lookups=args.single_lookups,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        concurrency=args.concurrency,
+        seed=args.seed,
+        slow_rate=args.slow_rate,
+        slow_ms=args.slow_ms
+    )
+    results.to_csv(args.output, index=False)
+
+    print(results.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+
+if __name__ == "__main__":
+    main()
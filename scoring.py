@@ -0,0 +1,113 @@
+import re
+import numpy as np
+
+RATING_PATTERN = re.compile(r"(\d+)\.(\d)\d*")
+RATINGS = np.arange(100) / 10
+DIGITS = "0123456789"
+
+def get_rating(completion):
+    match = re.search(r"(\d+\.\d+)", completion)
+    if not match:
+        return None
+    rating = float(match.group(0))
+    return rating
+
+def normalize_logprobs(logprobs):
+    # Chat completions logprobs (OpenAI) are used as they are, completions logprobs (Together) are converted to them.
+    if not logprobs:
+        return None
+    if isinstance(logprobs, list):
+        return logprobs
+    if logprobs.get('content'):
+        return logprobs['content']
+
+    tokens = logprobs.get('tokens')
+    if not tokens:
+        return None
+
+    token_logprobs = logprobs.get('token_logprobs') or [None] * len(tokens)
+    top_logprobs = logprobs.get('top_logprobs') or [None] * len(tokens)
+
+    entries = []
+    for token, logprob, alternatives in zip(tokens, token_logprobs, top_logprobs):
+        if isinstance(alternatives, dict):
+            alternatives = [{"token": key, "logprob": value} for key, value in alternatives.items()]
+        entries.append({"token": token, "logprob": logprob, "top_logprobs": alternatives or []})
+    return entries
+
+def digit_probabilities(entry, offsets):
+    # Only alternatives that differ from the token in the digits at `offsets` count. One axis of 10 per offset.
+    token = entry['token']
+    alternatives = entry.get('top_logprobs') or []
+    if not any(alternative['token'] == token for alternative in alternatives) and entry.get('logprob') is not None:
+        alternatives = alternatives + [{"token": token, "logprob": entry['logprob']}]
+
+    rest = [character for position, character in enumerate(token) if position not in offsets]
+    indices, logprobs = [], []
+    for alternative in alternatives:
+        text = alternative['token']
+        if len(text) != len(token) or [c for position, c in enumerate(text) if position not in offsets] != rest:
+            continue
+        if not all(text[offset] in DIGITS for offset in offsets):
+            continue
+        indices.append([int(text[offset]) for offset in offsets])
+        logprobs.append(alternative['logprob'])
+
+    probabilities = np.zeros((10,) * len(offsets))
+    if not indices:
+        probabilities[tuple(int(token[offset]) for offset in offsets)] = 1.0
+        return probabilities
+
+    logprobs = np.asarray(logprobs, dtype=np.float64)
+    np.add.at(probabilities, tuple(np.asarray(indices).T), np.exp(logprobs - logprobs.max()))
+    return probabilities / probabilities.sum()
+
+def locate(offsets, position):
+    index = int(np.searchsorted(offsets, position, side='right'))
+    return index, position - (offsets[index - 1] if index else 0)
+
+def get_distribution(logprobs):
+    tokens = [entry['token'] for entry in logprobs]
+    match = RATING_PATTERN.search("".join(tokens))
+    if not match or len(match.group(1)) != 1:
+        return None
+
+    offsets = np.cumsum([len(token) for token in tokens])
+    integer_token, integer_offset = locate(offsets, match.start(1))
+    decimal_token, decimal_offset = locate(offsets, match.start(2))
+
+    if integer_token == decimal_token:
+        joint = digit_probabilities(logprobs[integer_token], [integer_offset, decimal_offset])
+    else:
+        joint = np.outer(
+            digit_probabilities(logprobs[integer_token], [integer_offset]),
+            digit_probabilities(logprobs[decimal_token], [decimal_offset])
+        )
+    return joint.reshape(-1)
+
+def point_mass(rating):
+    if rating is None or not 0.0 <= rating < 10.0:
+        return None
+    distribution = np.zeros(len(RATINGS))
+    distribution[int(rating * 10 + 1e-9)] = 1.0
+    return distribution
+
+def sparse_distribution(distribution, digits=6):
+    return {f"{RATINGS[index]:.1f}": round(float(distribution[index]), digits) for index in np.nonzero(distribution)[0]}
+
+def score_completion(response):
+    # Without logprobs the distribution is a point mass at the rating and there is no expected value.
+    completion = response['completion']
+    most_probable = get_rating(completion)
+
+    if most_probable is None:
+        return completion, None, None, None
+
+    logprobs = normalize_logprobs(response.get('logprobs'))
+    distribution = get_distribution(logprobs) if logprobs else None
+    if distribution is None:
+        distribution = point_mass(most_probable)
+        return completion, most_probable, None, sparse_distribution(distribution) if distribution is not None else None
+
+    expected_value = float(distribution @ RATINGS)
+    return completion, most_probable, expected_value, sparse_distribution(distribution)
@@ -1,47 +1,75 @@
 import argparse
+import json
+import numpy as np
 from utils import *
-from itertools import combinations
-import math
+from prompt_store import filter_regions, get_prompt_text
 import random
 from tqdm import tqdm
 
-def distance(p1, p2):
-    return math.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
+class LazyLines:
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = rows
 
-def select_spread_out_points_with_importance_sampling(points, populations, num_points=2000, approx_sample=1000):
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return json.dumps({"text": get_prompt_text(self.store, self.rows[index])}) + "\n"
+
+def embed_points(points, metric="euclidean"):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if metric == "haversine":
+        lat, lon = np.radians(points[:, 0]), np.radians(points[:, 1])
+        return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    return points
+
+def squared_distances(points, squared_norms, targets):
+    return np.maximum(squared_norms[:, None] + (targets ** 2).sum(axis=1)[None, :] - 2 * points @ targets.T, 0)
+
+def select_spread_out_points_with_importance_sampling(points, populations, num_points=2000, approx_sample=1000, metric="euclidean", seed=None):
     if len(points) <= num_points:
         return range(len(points))
 
-    indices = list(range(len(points)))
-    indices.sort(key=lambda i: populations[i], reverse=True)
+    rng = np.random.default_rng(seed)
+
+    order = np.argsort(-np.asarray(populations, dtype=np.float64), kind="stable")
+    sorted_points = embed_points(points, metric)[order]
+    squared_norms = (sorted_points ** 2).sum(axis=1)
 
-    farthest_points_indices = set([0])
+    min_distances = np.full(len(order), np.inf)
+    selected = [int(np.nonzero(order == 0)[0][0])]
+    min_distances[selected[0]] = -1
+    computed = 0
 
     interval = len(points) // num_points
     population_cap_index = interval
 
     with tqdm(total=num_points, desc="Selecting Farthest Points") as pbar:
-        while len(farthest_points_indices) < num_points:
-            max_dist = -1
-            farthest_point_index = None
+        pbar.update(1)
 
-            populated_indices = indices[:population_cap_index] if population_cap_index < len(points) else indices
-            sampled_indices = random.sample(populated_indices, approx_sample) if len(populated_indices) > approx_sample else populated_indices
+        while len(selected) < num_points:
+            cap = min(population_cap_index, len(order))
+            population_cap_index += interval
 
-            for i in sampled_indices:
-                point = points[i]
-                if i not in farthest_points_indices:
-                    min_dist_to_set = min(distance(point, points[idx]) for idx in farthest_points_indices)
-                    if min_dist_to_set > max_dist:
-                        max_dist = min_dist_to_set
-                        farthest_point_index = i
+            if cap > computed:
+                new_distances = squared_distances(sorted_points[computed:cap], squared_norms[computed:cap], sorted_points[selected]).min(axis=1)
+                min_distances[computed:cap] = np.minimum(min_distances[computed:cap], new_distances)
+                computed = cap
 
-            farthest_points_indices.add(farthest_point_index)
+            candidates = rng.choice(cap, approx_sample, replace=False) if cap > approx_sample else np.arange(cap)
+            farthest_point_index = candidates[np.argmax(min_distances[candidates])]
+            if min_distances[farthest_point_index] < 0:
+                continue
+
+            selected.append(int(farthest_point_index))
+            new_distances = squared_distances(sorted_points[:computed], squared_norms[:computed], sorted_points[[farthest_point_index]])[:, 0]
+            min_distances[:computed] = np.minimum(min_distances[:computed], new_distances)
+            min_distances[farthest_point_index] = -1
 
-            population_cap_index += interval
             pbar.update(1)
 
-    return list(farthest_points_indices)
+    return order[selected].tolist()
 
 def main():
     parser = argparse.ArgumentParser(description="Select prompts for visualization")
@@ -49,6 +77,8 @@ def main():
     parser.add_argument("output_file", help="Output file path")
     parser.add_argument("num_points", type=int, help="Number of points to select")
     parser.add_argument("regions", nargs="+", help="List of regions")
+    parser.add_argument("--metric", choices=["euclidean", "haversine"], default="euclidean", help="Distance used for farthest point sampling")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible selections")
 
     args = parser.parse_args()
 
@@ -58,23 +88,24 @@ def main():
     file_name = args.prompts_file
     population_data_file_path = "data/ppp_2020_1km_Aggregated.tif"
 
-    with open(file_name, 'r') as infile:
-        lines = infile.readlines()
+    if is_prompt_store(file_name):
+        store = load_prompt_store(file_name)
+        rows = filter_regions(store, regions)
+        coordinates = np.column_stack([store["latitudes"][rows], store["longitudes"][rows]])
+        lines = LazyLines(store, rows)
+    else:
+        with open(file_name, 'r') as infile:
+            lines = infile.readlines()
 
-    lines = [line for line in lines if any(region in line for region in regions)]
-    coordinates = [get_coordinates(line) for line in lines]
+        lines = [line for line in lines if any(region in line for region in regions)]
+        coordinates = [get_coordinates(line) for line in lines]
 
-    with tqdm(total=len(coordinates), desc="Extracting Data") as pbar:
-        populations = []
-        for lat, lon in coordinates:
-            population = extract_data(lat, lon, population_data_file_path)
-            populations.append(population)
-            pbar.update(1)
+    populations = np.nan_to_num(extract_data_batch(coordinates, population_data_file_path))
 
-    indices = select_spread_out_points_with_importance_sampling(coordinates, populations, num_points)
+    indices = select_spread_out_points_with_importance_sampling(coordinates, populations, num_points, metric=args.metric, seed=args.seed)
     result = [lines[index] for index in indices]
 
-    random.shuffle(result)
+    random.Random(args.seed).shuffle(result)
 
     with open(output_file_path, 'w') as f:
         f.writelines(result)
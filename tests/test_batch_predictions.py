@@ -0,0 +1,39 @@
+import requests
+import batch_predictions
+from batch_predictions import get_custom_id, parse_custom_id, split_batches
+
+def test_split_batches_by_request_count():
+    lines = [b"x\n"] * 5
+    assert [len(batch) for batch in split_batches(lines, max_requests=2)] == [2, 2, 1]
+
+def test_split_batches_by_size():
+    lines = [b"aaaa\n", b"bb\n", b"cccc\n", b"d\n"]
+    assert split_batches(lines, max_bytes=8) == [[b"aaaa\n", b"bb\n"], [b"cccc\n", b"d\n"]]
+
+def test_oversized_line_gets_its_own_batch():
+    lines = [b"a\n", b"bbbbbbbbbb\n", b"c\n"]
+    assert split_batches(lines, max_bytes=4) == [[b"a\n"], [b"bbbbbbbbbb\n"], [b"c\n"]]
+
+def test_split_batches_empty():
+    assert split_batches([]) == []
+
+def test_custom_id_round_trip():
+    assert parse_custom_id(get_custom_id(2, 1234)) == (2, 1234)
+
+def test_upload_is_retried_with_the_whole_file(tmp_path, monkeypatch):
+    file_path = tmp_path / "batch-00000.jsonl"
+    file_path.write_bytes(b'{"custom_id": "0-0"}\n' * 40)
+    bodies = []
+
+    def request(method, url, files=None, **kwargs):
+        bodies.append(requests.Request(method, url, files=files, data=kwargs.get("data")).prepare().body)
+        response = requests.Response()
+        response.status_code = 503 if len(bodies) == 1 else 200
+        response._content = b'{"id": "file-1"}'
+        return response
+
+    monkeypatch.setattr(batch_predictions.requests, "request", request)
+    monkeypatch.setattr(batch_predictions.time, "sleep", lambda seconds: None)
+    assert batch_predictions.upload_file("http://test", "key", str(file_path)) == "file-1"
+    assert len(bodies) == 2
+    assert all(file_path.read_bytes() in body for body in bodies)
@@ -0,0 +1,15 @@
+from make_predictions_and_visualize import OPENAI_API_BASE, get_cache_key
+
+PROMPT = "Coordinates: (10.00000, 20.00000)\nAddress: x\n"
+
+def test_key_includes_the_resolved_endpoint():
+    default = get_cache_key("openai", "gpt-4o-mini", PROMPT)
+    assert get_cache_key("openai", "gpt-4o-mini", PROMPT, api_base=OPENAI_API_BASE) == default
+    assert get_cache_key("openai", "gpt-4o-mini", PROMPT, api_base="http://127.0.0.1:8799/v1") != default
+    assert get_cache_key("together", "gpt-4o-mini", PROMPT) != default
+
+def test_key_ignores_the_endpoint_for_providers_without_one():
+    assert get_cache_key("google", "gemini-pro", PROMPT, api_base="http://127.0.0.1:8799/v1") == get_cache_key("google", "gemini-pro", PROMPT)
+
+def test_key_depends_on_prefix_caching():
+    assert get_cache_key("openai", "gpt-4o-mini", PROMPT, prefix_caching=True) != get_cache_key("openai", "gpt-4o-mini", PROMPT)
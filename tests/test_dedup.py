@@ -0,0 +1,40 @@
+import numpy as np
+from dedup import count_unique, find_duplicate_groups, find_duplicates, get_location_keys
+
+def test_keys_match_prompt_formatting():
+    # "%.5f" formats 37.123455 as 37.12345 and 1.000005 as 1.00001, while np.round(value * 1e5) rounds the other way.
+    latitudes = [12.3456749, 12.34567, 37.123455, 37.12345, 37.12346, 1.000005, 1.00001, 1.0]
+    longitudes = [1.0] * len(latitudes)
+    keys = get_location_keys(latitudes, longitudes)
+    formatted = [(f"{lat:.5f}", f"{lon:.5f}") for lat, lon in zip(latitudes, longitudes)]
+    for i in range(len(keys)):
+        for j in range(len(keys)):
+            assert (keys[i] == keys[j]) == (formatted[i] == formatted[j])
+
+def test_keys_distinguish_nearby_locations():
+    keys = get_location_keys([10.0, 10.00001, 10.0, -10.0], [20.0, 20.0, 20.00001, 20.0])
+    assert len(set(keys.tolist())) == 4
+
+def test_geohash_keys():
+    keys = get_location_keys([37.7749, 37.7750, 40.7128], [-122.4194, -122.4195, -74.0060], geohash_length=6)
+    assert keys[0] == keys[1] != keys[2]
+
+def test_find_duplicates():
+    first, positions = find_duplicates([5, 3, 5, 7, 3])
+    assert first.tolist() == [0, 1, 3]
+    assert positions.tolist() == [0, 1, 0, 2, 1]
+
+def test_find_duplicate_groups():
+    groups = find_duplicate_groups([1.0, 2.0, 1.0, 3.0, 1.0], [1.0, 2.0, 1.0, 3.0, 1.0])
+    assert groups == {0: (0, 2, 4), 2: (0, 2, 4), 4: (0, 2, 4)}
+    assert count_unique(5, groups) == 3
+
+def test_find_duplicate_groups_with_texts():
+    groups = find_duplicate_groups([1.0, 1.0, 1.0], [1.0, 1.0, 1.0], ["a", "b", "a"])
+    assert groups == {0: (0, 2), 2: (0, 2)}
+    assert count_unique(3, groups) == 2
+
+def test_empty():
+    assert find_duplicate_groups([], []) == {}
+    assert count_unique(0, {}) == 0
+    assert len(get_location_keys(np.zeros(0), np.zeros(0))) == 0
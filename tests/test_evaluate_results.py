@@ -0,0 +1,10 @@
+import pandas as pd
+from evaluate_results import load_results
+
+def test_load_results_skips_adaptive_surfaces(tmp_path):
+    frame = pd.DataFrame({"Latitude": [10.0, 11.0], "Longitude": [20.0, 21.0], "Predictions": [1.0, 2.0]})
+    frame.to_csv(tmp_path / "m_population_p.csv", index=False)
+    frame.assign(Uncertainty=0.0, Queried=True).to_csv(tmp_path / "m_population_p_adaptive.csv", index=False)
+    pd.DataFrame({"Task": ["population"], "Prompts": [2]}).to_csv(tmp_path / "m_p_summary.csv", index=False)
+
+    assert list(load_results(str(tmp_path))) == [str(tmp_path / "m_population_p.csv")]
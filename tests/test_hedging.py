@@ -0,0 +1,125 @@
+import asyncio
+import itertools
+import threading
+import time
+import pytest
+import requests
+import hedging
+from hedging import Hedger, call_with_retries
+
+def primed_hedger(max_fraction=1.0, latency=0.01):
+    hedger = Hedger("test", quantile=0.95, max_fraction=max_fraction)
+    for _ in range(hedging.MIN_SAMPLES):
+        hedger.tracker.observe(latency)
+    return hedger
+
+def slow_then_fast(delay=2.0):
+    calls = itertools.count()
+    release = threading.Event()
+
+    def function():
+        if next(calls) == 0:
+            release.wait(delay)
+            return "slow"
+        return "fast"
+    return function, release
+
+def test_hedge_answers_first():
+    hedger = primed_hedger()
+    function, release = slow_then_fast()
+    start_time = time.monotonic()
+    try:
+        assert hedger.call(function, timeout=5) == "fast"
+        assert time.monotonic() - start_time < 1
+        assert hedger.hedges == 1
+    finally:
+        release.set()
+        hedger.close()
+
+def test_no_hedge_before_enough_samples():
+    hedger = Hedger("test", max_fraction=1.0)
+    function, release = slow_then_fast(delay=0.2)
+    try:
+        assert hedger.call(function, timeout=5) == "slow"
+        assert hedger.hedges == 0
+    finally:
+        release.set()
+        hedger.close()
+
+def test_hedges_are_capped():
+    hedger = primed_hedger(max_fraction=0.0)
+    function, release = slow_then_fast(delay=0.2)
+    try:
+        assert hedger.call(function, timeout=5) == "slow"
+        assert hedger.hedges == 0
+    finally:
+        release.set()
+        hedger.close()
+
+def test_timeout():
+    hedger = primed_hedger(max_fraction=0.0)
+    release = threading.Event()
+    try:
+        with pytest.raises(TimeoutError):
+            hedger.call(lambda: release.wait(5), timeout=0.1)
+    finally:
+        release.set()
+        hedger.close()
+
+def test_error_is_raised():
+    hedger = Hedger("test")
+    def function():
+        raise ValueError("bad request")
+    try:
+        with pytest.raises(ValueError):
+            hedger.call(function, timeout=1)
+    finally:
+        hedger.close()
+
+def test_call_async_hedge_answers_first():
+    hedger = primed_hedger()
+    calls = itertools.count()
+
+    async def function():
+        if next(calls) == 0:
+            await asyncio.sleep(2)
+            return "slow"
+        return "fast"
+
+    start_time = time.monotonic()
+    assert asyncio.run(hedger.call_async(function, timeout=5)) == "fast"
+    assert time.monotonic() - start_time < 1
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(response=response)
+
+def test_call_with_retries(monkeypatch):
+    monkeypatch.setattr(hedging, "BACKOFF_BASE", 0.0)
+    hedger = Hedger("test")
+    errors = [TimeoutError(), http_error(429)]
+
+    def function():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    try:
+        assert call_with_retries(hedger, function, timeout=1, max_retries=2, retryable_errors=(TimeoutError, requests.exceptions.HTTPError)) == "ok"
+    finally:
+        hedger.close()
+
+def test_call_with_retries_gives_up(monkeypatch):
+    monkeypatch.setattr(hedging, "BACKOFF_BASE", 0.0)
+    hedger = Hedger("test")
+    calls = itertools.count()
+
+    def function():
+        next(calls)
+        raise http_error(401)
+    try:
+        with pytest.raises(requests.exceptions.HTTPError):
+            call_with_retries(hedger, function, timeout=1, max_retries=3, retryable_errors=(requests.exceptions.HTTPError,))
+        assert next(calls) == 1
+    finally:
+        hedger.close()
@@ -0,0 +1,34 @@
+import numpy as np
+import metrics
+
+def test_normalized_fractional_ranking():
+    ranks = metrics.normalized_fractional_ranking([3, 1, 2, 2])
+    np.testing.assert_allclose(ranks, [0.75, 0.0, 0.375, 0.375])
+
+def test_normalized_fractional_ranking_keeps_nans():
+    ranks = metrics.normalized_fractional_ranking([3, np.nan, 1])
+    np.testing.assert_allclose(ranks, [0.5, np.nan, 0.0])
+
+def test_normalized_fractional_ranking_columns():
+    ranks = metrics.normalized_fractional_ranking([[1, 2], [2, 1]])
+    np.testing.assert_allclose(ranks, [[0.0, 0.5], [0.5, 0.0]])
+
+def test_empty_input():
+    assert metrics.normalized_fractional_ranking([]).shape == (0,)
+    assert metrics.normalized_fractional_ranking(np.zeros((0, 3))).shape == (0, 3)
+    assert np.isnan(metrics.spearman_correlation([], []))
+    assert np.isnan(metrics.bias_score([], [], 0))
+
+def test_spearman_correlation():
+    assert metrics.spearman_correlation([1, 2, 3, 4], [10, 20, 30, 40]) == 1.0
+    assert metrics.spearman_correlation([4, 3, 2, 1], [10, 20, 30, 40]) == -1.0
+    np.testing.assert_allclose(metrics.spearman_correlation([[1, 4], [2, 3], [3, 2]], [1, 2, 3]), [1.0, -1.0])
+
+def test_spearman_correlation_ignores_missing_rows():
+    assert metrics.spearman_correlation([1, np.nan, 3, 2], [1, 100, 3, 2]) == 1.0
+    assert np.isnan(metrics.spearman_correlation([1, np.nan], [1, 2]))
+
+def test_answer_rate():
+    assert metrics.answer_rate([1, np.nan, 2], 4) == 0.5
+    assert metrics.answer_rate([], 0) == 0.0
+    np.testing.assert_allclose(metrics.answer_rate([[1, np.nan], [2, 3]], np.array([2, 4])), [1.0, 0.25])
@@ -0,0 +1,26 @@
+import os
+import pytest
+from prompt_shards import get_marker_file, get_shards_dir, merge_shards, run_shards
+
+def write_prompts(coordinates, part_file, skip=()):
+    written = [coordinate for coordinate in coordinates if coordinate not in skip]
+    with open(part_file, "w") as file:
+        for coordinate in written:
+            file.write(f"{coordinate}\n")
+    return len(written)
+
+def test_shards_with_failed_rows_stay_incomplete(tmp_path):
+    output_file = str(tmp_path / "prompts.jsonl")
+    coordinates = list(range(10))
+
+    manifest = run_shards(write_prompts, coordinates, output_file, 2, skip=(7,))
+    assert [entry["complete"] for entry in manifest["shards"]] == [True, False]
+    assert not os.path.exists(get_marker_file(get_shards_dir(output_file), 1))
+    with pytest.raises(ValueError):
+        merge_shards(output_file)
+
+    manifest = run_shards(write_prompts, coordinates, output_file, 2)
+    assert all(entry["complete"] for entry in manifest["shards"])
+    assert merge_shards(output_file) == 10
+    with open(output_file) as file:
+        assert file.read().split() == list(map(str, coordinates))
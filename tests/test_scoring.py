@@ -0,0 +1,44 @@
+import math
+import pytest
+from scoring import normalize_logprobs, score_completion
+
+def entry(token, logprob, alternatives=()):
+    return {"token": token, "logprob": logprob, "top_logprobs": [{"token": t, "logprob": l} for t, l in alternatives]}
+
+def test_no_rating():
+    assert score_completion({"completion": "I cannot answer that."}) == ("I cannot answer that.", None, None, None)
+
+def test_without_logprobs():
+    completion, most_probable, expected_value, distribution = score_completion({"completion": " 6.3", "logprobs": None})
+    assert most_probable == 6.3
+    assert expected_value is None
+    assert distribution == {"6.3": 1.0}
+
+def test_out_of_range_rating_has_no_distribution():
+    assert score_completion({"completion": "12.5"})[1:] == (12.5, None, None)
+
+def test_expected_value_from_separate_digit_tokens():
+    logprobs = [
+        entry("6", math.log(0.75), [("6", math.log(0.75)), ("4", math.log(0.25))]),
+        entry(".", 0.0),
+        entry("0", 0.0, [("0", 0.0)])
+    ]
+    _, most_probable, expected_value, distribution = score_completion({"completion": "6.0", "logprobs": logprobs})
+    assert most_probable == 6.0
+    assert expected_value == pytest.approx(0.75 * 6.0 + 0.25 * 4.0)
+    assert distribution == {"4.0": 0.25, "6.0": 0.75}
+
+def test_expected_value_after_leading_text():
+    logprobs = [
+        entry("Rating", 0.0),
+        entry(":", 0.0),
+        entry(" 3.5", math.log(0.5), [(" 3.5", math.log(0.5)), (" 3.7", math.log(0.5)), (" high", math.log(0.1))])
+    ]
+    _, most_probable, expected_value, _ = score_completion({"completion": "Rating: 3.5", "logprobs": logprobs})
+    assert most_probable == 3.5
+    assert expected_value == pytest.approx(3.6)
+
+def test_together_logprobs_are_normalized():
+    logprobs = {"tokens": ["2", ".", "0"], "token_logprobs": [-0.1, 0.0, 0.0], "top_logprobs": [{"2": -0.1}, {".": 0.0}, {"0": 0.0}]}
+    assert normalize_logprobs(logprobs)[0] == {"token": "2", "logprob": -0.1, "top_logprobs": [{"token": "2", "logprob": -0.1}]}
+    assert score_completion({"completion": "2.0", "logprobs": logprobs})[2] == pytest.approx(2.0)
@@ -1,5 +1,11 @@
+import json
+import os
+import numpy as np
 import rasterio
+from rasterio.transform import Affine
 import jsonlines
+import metrics
+from prompt_store import is_prompt_store, load_prompt_store, PromptTexts
 
 PREFIX = """You will be given data about a specific location randomly sampled from all human-populated locations on Earth.
 You give your rating keeping in mind that it is relative to all other human-populated locations on Earth (from all continents, countries, etc.).
@@ -9,12 +15,42 @@ You provide ONLY your answer in the exact format "My answer is X.X." where 'X.X'
 """
 
 ADJACENT_PIXELS = 12
+SAMPLING_TILE_SIZE = 512
+
+class RenderedPrompts:
+    def __init__(self, texts, task):
+        self.texts = texts
+        self.task = task
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        return PREFIX + self.texts[index].replace("<TASK>", self.task)
+
+    def __iter__(self):
+        return (PREFIX + text.replace("<TASK>", self.task) for text in self.texts)
+
+def load_prompt_table(file_path):
+    if is_prompt_store(file_path):
+        store = load_prompt_store(file_path)
+        return {"latitudes": store["latitudes"], "longitudes": store["longitudes"], "texts": PromptTexts(store)}
 
-def load_geollm_prompts(file_path, task):
     with jsonlines.open(file_path, 'r') as reader:
-        data = list(reader)
-    geollm_prompts = [PREFIX + item['text'].strip().replace("<TASK>", task) for item in data]
-    return geollm_prompts
+        texts = [item['text'].strip() for item in reader]
+    coordinates = np.array([get_coordinates(text) for text in texts], dtype=np.float64).reshape(-1, 2)
+    return {"latitudes": coordinates[:, 0], "longitudes": coordinates[:, 1], "texts": texts}
+
+def render_prompts(table, task):
+    return RenderedPrompts(table["texts"], task)
+
+def split_prompt(prompt):
+    if prompt.startswith(PREFIX):
+        return PREFIX.strip(), prompt[len(PREFIX):]
+    return None, prompt
+
+def load_geollm_prompts(file_path, task):
+    return list(render_prompts(load_prompt_table(file_path), task))
 
 def get_coordinates(text):
     text = text.split("Coordinates: ")[1]
@@ -23,29 +59,83 @@ def get_coordinates(text):
     return lat, lon
 
 def normalized_fractional_ranking(numbers):
-    sorted_numbers = sorted(enumerate(numbers), key=lambda x: x[1])
+    return metrics.normalized_fractional_ranking(numbers)
 
-    ranks = {}
-    for rank, (original_index, number) in enumerate(sorted_numbers):
-        if number in ranks:
-            ranks[number][0] += rank + 1
-            ranks[number][1] += 1
-        else:
-            ranks[number] = [rank + 1, 1]
+def summed_area_table(data):
+    table = np.zeros((data.shape[0] + 1, data.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(np.where(data >= 0, data, 0), axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+    return table
 
-    average_ranks = {number: total_rank / count for number, (total_rank, count) in ranks.items()}
+def neighborhood_sums(table, rows, cols):
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    row_start, row_stop = np.maximum(rows - ADJACENT_PIXELS, 0), np.minimum(rows + ADJACENT_PIXELS + 1, height)
+    col_start, col_stop = np.maximum(cols - ADJACENT_PIXELS, 0), np.minimum(cols + ADJACENT_PIXELS + 1, width)
+    return table[row_stop, col_stop] - table[row_start, col_stop] - table[row_stop, col_start] + table[row_start, col_start]
 
-    return [(average_ranks[number] - 1) / len(numbers) for number in numbers]
+def get_neighborhood_sums_files(file_path):
+    return f"{file_path}.sums.npy", f"{file_path}.sums.json"
+
+def load_neighborhood_sums(file_path):
+    """Memory-mapped neighborhood sums written by preprocess_raster.py, or None if there are none for this version of
+    the raster (same size and modification time) and ADJACENT_PIXELS."""
+    sums_file, metadata_file = get_neighborhood_sums_files(file_path)
+    if not os.path.exists(metadata_file) or not os.path.exists(sums_file):
+        return None
+
+    with open(metadata_file, "r") as file:
+        metadata = json.load(file)
+    stat = os.stat(file_path)
+    if (metadata["source_size"], metadata["source_mtime_ns"], metadata["adjacent_pixels"]) != (stat.st_size, stat.st_mtime_ns, ADJACENT_PIXELS):
+        return None
+
+    return np.load(sums_file, mmap_mode="r"), Affine(*metadata["transform"])
+
+def raster_indices(coordinates, transform, width, height):
+    x, y = ~transform * (coordinates[:, 1], coordinates[:, 0])
+    x, y = np.nan_to_num(np.round(x), nan=-1), np.nan_to_num(np.round(y), nan=-1)
+    inside = (0 <= x) & (x < width) & (0 <= y) & (y < height)
+    points = np.nonzero(inside)[0]
+    return points, x[points].astype(np.int64), y[points].astype(np.int64)
+
+def extract_data_batch(coordinates, file_path):
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    totals = np.full(len(coordinates), np.nan)
+
+    precomputed = load_neighborhood_sums(file_path)
+    if precomputed is not None:
+        sums, transform = precomputed
+        points, px, py = raster_indices(coordinates, transform, sums.shape[1], sums.shape[0])
+        order = np.argsort(py * sums.shape[1] + px, kind='stable')
+        totals[points[order]] = sums[py[order], px[order]]
+        return totals
 
-def extract_data(lat, lon, file_path):
     with rasterio.open(file_path) as src:
-        transform = ~src.transform
-        x, y = transform * (lon, lat)
-        px, py = round(x), round(y)
+        points, px, py = raster_indices(coordinates, src.transform, src.width, src.height)
 
-        window = ((max(py-ADJACENT_PIXELS, 0), min(py+ADJACENT_PIXELS+1, src.height)), (max(px-ADJACENT_PIXELS, 0), min(px+ADJACENT_PIXELS+1, src.width)))
-        data = src.read(1, window=window)
-        non_negative_data = data[data >= 0]
-        total_population = non_negative_data.sum()
+        block_height, block_width = src.block_shapes[0]
+        tile_height = -(-SAMPLING_TILE_SIZE // block_height) * block_height
+        tile_width = -(-SAMPLING_TILE_SIZE // block_width) * block_width
+        tiles_per_row = -(-src.width // tile_width)
 
-        return total_population if 0 <= px < src.width and 0 <= py < src.height else None
\ No newline at end of file
+        tile_ids = (py // tile_height) * tiles_per_row + px // tile_width
+        order = np.argsort(tile_ids, kind='stable')
+        points, px, py, tile_ids = points[order], px[order], py[order], tile_ids[order]
+        unique_tiles, starts = np.unique(tile_ids, return_index=True)
+        stops = np.append(starts[1:], len(points))
+
+        for tile_id, start, stop in zip(unique_tiles, starts, stops):
+            tile_row, tile_col = divmod(int(tile_id), tiles_per_row)
+            row_start = max(tile_row * tile_height - ADJACENT_PIXELS, 0)
+            row_stop = min((tile_row + 1) * tile_height + ADJACENT_PIXELS, src.height)
+            col_start = max(tile_col * tile_width - ADJACENT_PIXELS, 0)
+            col_stop = min((tile_col + 1) * tile_width + ADJACENT_PIXELS, src.width)
+
+            data = src.read(1, window=((row_start, row_stop), (col_start, col_stop)))
+            table = summed_area_table(data)
+            totals[points[start:stop]] = neighborhood_sums(table, py[start:stop] - row_start, px[start:stop] - col_start)
+
+    return totals
+
+def extract_data(lat, lon, file_path):
+    total_population = extract_data_batch([(lat, lon)], file_path)[0]
+    return None if np.isnan(total_population) else total_population